@@ -1,24 +1,32 @@
 import os
 import sys
-import xml.etree.ElementTree as ET
-import xml.dom.minidom
+# lxml serializes and pretty-prints in C; fall back to the stdlib if it is missing
+try:
+    from lxml import etree as ET
+    HAS_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    HAS_LXML = False
 import streamlit as st
 import xmlschema
-import yaml
 import re
 import csv
 import io
 import uuid
 import datetime
-from openpyxl import Workbook
-from openpyxl.worksheet.table import Table, TableStyleInfo
-from openpyxl.styles import Alignment
-from openpyxl.utils import get_column_letter
-import pandas as pd
-from sqlalchemy import create_engine
-import copy
-import uuid
+# yaml, openpyxl, pandas and sqlalchemy are imported where they are used: openpyxl
+# only builds the Excel export on download, pandas and sqlalchemy only serve the
+# optional IFS database source, and deferring them takes over a second off a cold start.
 import zipfile
+import copy
+import pickle
+import hashlib
+import threading
+import functools
+from dataclasses import dataclass
+
+# Data files are resolved relative to this script
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # Page configuration
 st.set_page_config(page_title="EUDAMED XML Generator", layout="wide")
@@ -45,31 +53,100 @@ st.markdown("""
 def load_config(product_group):
     """Load YAML configuration for the selected product group."""
     if not product_group:
-        return {}
+        return ConfigDefaults({})
         
     filename = f"EUDAMED_data_{product_group}.yaml"
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    file_path = os.path.join(base_dir, filename)
+    file_path = os.path.join(_BASE_DIR, filename)
     
-    if not os.path.exists(file_path):
+    try:
+        mtime = os.path.getmtime(file_path)
+    except OSError:
         return None # Signal missing file
-        
+
+    # The modification time is part of the cache key, so editing the YAML reloads it
+    return _parse_config_file(file_path, mtime)
+
+# cache_resource hands out the same object on every rerun instead of unpickling a copy,
+# so the path index below is built once per file version. Callers only read it.
+# Every saved edit adds a new (path, mtime) entry, so the caches are bounded.
+@st.cache_resource(show_spinner=False, max_entries=16)
+def _parse_config_file(file_path, mtime):
+    """Parse a product-group YAML file once per modification time."""
+    import yaml
+    # LibYAML's C parser when PyYAML was built with it, else the pure-Python one
+    YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = yaml.safe_load(f) or {}
+        # Binary stream: the loader detects the encoding and LibYAML decodes in C
+        with open(file_path, 'rb') as f:
+            data = yaml.load(f, Loader=YamlLoader) or {}
             # Return only 'defaults'.
-            return data.get('defaults', {})
+            return ConfigDefaults(data.get('defaults', {}))
     except Exception as e:
-        st.error(f"Error loading config {filename}: {e}")
-        return {}
+        st.error(f"Error loading config {os.path.basename(file_path)}: {e}")
+        return ConfigDefaults({})
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _read_config_text(file_path, mtime):
+    """Raw text of a product-group YAML file, for display."""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+_CONFIG_FILE_RE = re.compile(r'^EUDAMED_data_(.+)\.yaml$')
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def discover_groups(base_dir, dir_mtime):
+    """
+    Product groups with an EUDAMED_data_<group>.yaml file, rescanned when the directory changes.
+    Only the latest directory versions are kept; older mtimes are never asked for again.
+    """
+    groups = []
+    with os.scandir(base_dir) as entries:
+        for entry in entries:
+            match = _CONFIG_FILE_RE.match(entry.name)
+            if match and entry.is_file():
+                groups.append(match.group(1))
+    return sorted(groups)
+
+class ConfigDefaults(dict):
+    """Configured default values keyed by XML path, plus the set of all their ancestor paths."""
+
+    def __init__(self, defaults):
+        super().__init__(defaults)
+        # Every "A/B" that precedes a "/" in some key, so prefix checks are set lookups
+        self.prefixes = frozenset(k[:i] for k in self for i, ch in enumerate(k) if ch == '/')
+        # Configured list indices per repeated path: "A/B[1]/C" gives {"A/B": {1}}
+        self.list_indices = {}
+        for path in self.prefixes.union(self):
+            if path.endswith(']'):
+                base, _, index = path[:-1].rpartition('[')
+                if base and index.isdigit():
+                    self.list_indices.setdefault(base, set()).add(int(index))
+        # (is_visible, default) per field, keyed by ((id(step), path), force_visible); plan
+        # steps are cached for the process, so this fills once and is reused by every rerun
+        self.resolved = {}
+        # The same per-version reuse for model groups: (is_configured, indexed count) per
+        # group element and the (default option, forced) pick per choice, keyed by (id(step), path)
+        self.group_layout = {}
+
+    def has_children(self, path):
+        """True if any configured path lies below the given path."""
+        return path in self.prefixes
+
+    def list_count(self, path):
+        """Number of consecutively configured entries path[0], path[1], ... of a repeated element."""
+        indices = self.list_indices.get(path)
+        count = 0
+        if indices:
+            while count in indices:
+                count += 1
+        return count
 
 @st.cache_resource
 def load_eudamed_metadata():
     """Load and cache metadata from EUDAMED CSV files."""
     metadata = {}
     all_headers = set()
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    csv_dir = os.path.join(base_dir, 'EUDAMED downloaded')
+    csv_dir = os.path.join(_BASE_DIR, 'EUDAMED downloaded')
     
     files = ['basic-udi.csv', 'udi-di.csv']
     
@@ -77,665 +154,1096 @@ def load_eudamed_metadata():
         path = os.path.join(csv_dir, filename)
         if os.path.exists(path):
             try:
-                with open(path, 'r', encoding='utf-8-sig', errors='replace') as f:
-                    # csv.DictReader might struggle if headers have BOM or spaces
-                    # Read first line to clean headers
-                    lines = f.readlines()
-                    if not lines: continue
+                # newline='' hands line endings to the csv module, as it expects, so the
+                # file streams straight into the reader without newline translation
+                with open(path, 'r', encoding='utf-8-sig', errors='replace', newline='') as f:
+                    # Single csv.reader pass; rows become dicts only for rows with a Field ID
+                    reader = csv.reader(f)
+                    raw_headers = next(reader, None)
+                    if not raw_headers: continue
                     
-                    # Use csv.reader to correctly parse headers (handles quotes)
-                    header_reader = csv.reader([lines[0]])
-                    raw_headers = next(header_reader)
-                    
-                    # Filter empty headers
-                    headers = [h.strip() for h in raw_headers if h and h.strip()]
+                    # Filter empty headers. Interned, so every row dict, export column dict and
+                    # export lookup shares one string object per column name.
+                    headers = [sys.intern(h.strip()) for h in raw_headers if h and h.strip()]
                     all_headers.update(headers)
+                    if 'Field ID' not in headers: continue
+                    fld_idx = headers.index('Field ID')
+                    n_headers = len(headers)
                     
-                    # Use the cleaned headers
-                    reader = csv.DictReader(lines[1:], fieldnames=headers)
-                    
-                    for row in reader:
-                        # Find the Field ID (it might be 'Field ID' or 'Field ID ' etc)
-                        # We cleaned headers so it should be 'Field ID'
-                        fld_id = row.get('Field ID')
+                    for values in reader:
+                        # Same row shape as csv.DictReader: blank lines are skipped,
+                        # missing cells are None and extra cells are listed under None
+                        if not values or len(values) <= fld_idx: continue
+                        fld_id = values[fld_idx]
                         if fld_id:
+                            row = dict(zip(headers, values))
+                            if len(values) > n_headers:
+                                row[None] = values[n_headers:]
+                            elif len(values) < n_headers:
+                                for key in headers[len(values):]:
+                                    row.setdefault(key, None)
                             metadata[fld_id] = row
             except Exception as e:
                 st.error(f"Error loading metadata from {filename}: {e}")
                 
-    # Sort headers to ensure consistent order
-    sorted_headers = sorted(list(all_headers))
-    # Make sure Field ID is present if not
-    if 'Field ID' in sorted_headers:
-         sorted_headers.remove('Field ID')
+    # Sort headers to ensure consistent order; Field ID is not exported as a column
+    sorted_headers = sorted(h for h in all_headers if h != 'Field ID')
         
     return metadata, sorted_headers
 
 @st.cache_resource
 def load_schema():
     """Load and cache the XML schema."""
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    xsd_path = os.path.join(base_dir, 'EUDAMED downloaded', 'XSD', 'service', 'Message.xsd')
+    xsd_path = os.path.join(_BASE_DIR, 'EUDAMED downloaded', 'XSD', 'service', 'Message.xsd')
     
     if not os.path.exists(xsd_path):
         return None, f"Schema file not found at: {xsd_path}"
 
+    # Building the schema is the slowest part of a cold start, so the built schema
+    # is pickled next to the XSD and reused while the XSD files are unchanged.
+    # Unchanged mtimes and sizes are trusted as is; otherwise the signature hashes
+    # the file contents, so a fresh checkout or copy of identical files keeps using the cache.
+    cache_path = xsd_path + ".pkl"
+    xsd_root = os.path.join(_BASE_DIR, 'EUDAMED downloaded', 'XSD')
+    xsd_files = []
+    for dirpath, dirnames, names in os.walk(xsd_root):
+        dirnames.sort()
+        for name in sorted(names):
+            if name.endswith('.xsd'):
+                file_path = os.path.join(dirpath, name)
+                xsd_files.append((os.path.relpath(file_path, xsd_root), file_path))
+    stamp = [xmlschema.__version__]
+    for rel_path, file_path in xsd_files:
+        file_stat = os.stat(file_path)
+        stamp.append((rel_path, file_stat.st_mtime_ns, file_stat.st_size))
+    stamp = tuple(stamp)
+
+    def content_signature():
+        digest = hashlib.sha256(xmlschema.__version__.encode())
+        for rel_path, file_path in xsd_files:
+            digest.update(rel_path.encode())
+            with open(file_path, 'rb') as f:
+                digest.update(f.read())
+        return digest.hexdigest()
+
+    def write_cache(header, body):
+        """Writes the header and the pickled (schema, annotations) body to the cache file."""
+        try:
+            # Write to a temporary file first so a concurrent start never reads a partial pickle
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.write(body)
+            os.replace(tmp_path, cache_path)
+        except Exception as e:
+            print(f"Could not write schema cache {cache_path}: {e}")
+
+    signature = None
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'rb') as f:
+                # The (stamp, signature) header is pickled first, so a stale cache is
+                # rejected without unpickling the schema behind it
+                cached_stamp, cached_signature = pickle.load(f)
+                if cached_stamp != stamp:
+                    signature = content_signature()
+                if cached_stamp == stamp or cached_signature == signature:
+                    body = f.read()
+                    schema, annotations = pickle.loads(body)
+                    # Restore the cached annotation properties (see below). The pickle layout
+                    # follows xmlschema internals, so anything that does not restore cleanly
+                    # is rebuilt from the XSD instead of being served half-restored.
+                    if not isinstance(schema, xmlschema.XMLSchemaBase) or not schema.built:
+                        raise ValueError("cached schema is not a built XMLSchema")
+                    for component, annotation in annotations:
+                        component.annotation = annotation
+                        if component.annotation is not annotation:
+                            raise ValueError(f"could not restore the annotation of {component!r}")
+                    if cached_stamp != stamp:
+                        # Same contents with new mtimes (fresh checkout or copy): store the
+                        # new stamp so later starts are accepted without hashing again
+                        write_cache((stamp, signature), body)
+                    return schema, None
+        except Exception as e:
+            print(f"Ignoring schema cache {cache_path}: {e}")
+
     try:
         schema = xmlschema.XMLSchema(xsd_path)
-        return schema, None
     except Exception as e:
         return None, f"Failed to load schema: {e}"
 
+    try:
+        # xmlschema does not pickle cached properties, and some annotations (e.g. on
+        # named simple types) cannot be re-derived afterwards, so they are stored alongside.
+        annotations = [(c, c.annotation) for c in schema.maps.iter_components()
+                       if getattr(c, 'annotation', None) is not None]
+        body = pickle.dumps((schema, annotations), protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        print(f"Could not write schema cache {cache_path}: {e}")
+    else:
+        if signature is None:
+            signature = content_signature()
+        write_cache((stamp, signature), body)
+
+    return schema, None
+
+@st.cache_resource
+def load_lxml_schema():
+    """
+    Load the same schema into libxml2 for fast validation.
+    Returns (validator, lock), or None without lxml or if libxml2 rejects the XSD.
+    """
+    if not HAS_LXML:
+        return None
+    xsd_path = os.path.join(_BASE_DIR, 'EUDAMED downloaded', 'XSD', 'service', 'Message.xsd')
+    try:
+        validator = ET.XMLSchema(ET.parse(xsd_path))
+    except Exception as e:
+        print(f"lxml could not load {xsd_path}, validating with xmlschema: {e}")
+        return None
+    # The validator keeps its error log on itself, so sessions take turns
+    return validator, threading.Lock()
+
+@st.cache_resource
+def _memo_table(name):
+    """
+    Returns a process-wide dict for the given name.
+    Module-level dicts are recreated on every Streamlit rerun (the script is re-executed),
+    so lookup tables that must survive reruns are obtained from here.
+    """
+    return {}
+
+def _memoize_by_id(name):
+    """
+    Memoizes a one-argument schema helper in _memo_table(name), keyed by id(arg).
+    Entries are (arg, value) so the XSD component stays referenced and its id cannot be
+    reused. The tables are cache resources like the schema, so they are cleared with it.
+    """
+    def decorator(func):
+        table = _memo_table(name)
+
+        @functools.wraps(func)
+        def wrapper(obj):
+            cached = table.get(id(obj))
+            if cached is not None:
+                return cached[1]
+            result = func(obj)
+            table[id(obj)] = (obj, result)
+            return result
+        return wrapper
+    return decorator
+
+# XSD whiteSpace normalization, as applied before pattern facets are checked
+_WHITESPACE_CHAR = re.compile(r'\s')
+_WHITESPACE_RUN = re.compile(r'\s+')
+
+@_memoize_by_id("pattern_hints")
+def get_pattern_hint(type_obj):
+    """
+    Returns (compiled patterns, mismatch message) for the type's pattern facet, or None.
+    The patterns are the ones xmlschema already translated from XSD regex syntax,
+    so matching them agrees with the full validator.
+    """
+    facet = getattr(type_obj, 'patterns', None)
+    if facet is not None and getattr(facet, 'patterns', None):
+        # Same reason text as xmlschema's pattern facet error
+        return (tuple(facet.patterns),
+                f"❌ Invalid format: value doesn't match any pattern of {facet.regexps!r}")
+    return None
+
+def _hint_message(pattern_hint, min_length, white_space, val):
+    """Message for a value failing the given minLength or pattern facet, else None."""
+    text = val
+    if white_space == 'replace':
+        text = _WHITESPACE_CHAR.sub(' ', val)
+    elif white_space == 'collapse':
+        text = _WHITESPACE_RUN.sub(' ', val).strip()
+    if min_length is not None and len(text) < min_length:
+        # Same reason text as xmlschema's minLength facet error
+        return f"❌ Too short: value length cannot be lesser than {min_length}"
+    if pattern_hint is not None:
+        patterns, mismatch_msg = pattern_hint
+        if not any(p.match(text) for p in patterns):
+            return mismatch_msg
+    return None
+
+@st.cache_resource
+def _hint_memo():
+    """
+    Process-wide bounded memo of _hint_message. Fields of the same type share entries
+    across UDI-DI entries, reruns and sessions, e.g. identical codes in every entry.
+    """
+    return functools.lru_cache(maxsize=4096)(_hint_message)
+
+_HINT_MEMO = _hint_memo()
+
+def check_pattern_hint(step, val):
+    """
+    Cheap per-field hint: returns a message if the value fails the field's minLength or
+    pattern facet, else None. maxLength is enforced by the input widget itself.
+    Full schema validation runs once on the generated XML.
+    """
+    if step.pattern_hint is None and step.min_length is None:
+        return None
+    # Only text values are hashable memo keys
+    check = _HINT_MEMO if isinstance(val, str) else _hint_message
+    return check(step.pattern_hint, step.min_length, step.white_space, val)
+
+@_memoize_by_id("enums")
 def get_enums_for_type(type_obj):
-    """Extract enumeration values from a type object."""
+    """Extract enumeration values from a type object. Returns a tuple of strings or None."""
     enums = None
     if type_obj.is_simple():
-        if hasattr(type_obj, 'enumeration') and type_obj.enumeration:
-            enums = type_obj.enumeration
-        elif hasattr(type_obj, 'base_type') and hasattr(type_obj.base_type, 'enumeration') and type_obj.base_type.enumeration:
-             enums = type_obj.base_type.enumeration
-    return [str(e) for e in enums] if enums else None
+        # getattr with a default is a single lookup, unlike hasattr followed by access
+        enums = getattr(type_obj, 'enumeration', None) or \
+                getattr(getattr(type_obj, 'base_type', None), 'enumeration', None)
+    # A tuple, so callers cannot modify the cached value
+    return tuple(str(e) for e in enums) if enums else None
 
+@_memoize_by_id("constraints")
 def get_type_constraints_help(type_obj):
     """Generate a help string for type constraints."""
     constraints = []
-    if hasattr(type_obj, 'min_length') and type_obj.min_length is not None:
-        constraints.append(f"Min Length: {type_obj.min_length}")
-    if hasattr(type_obj, 'max_length') and type_obj.max_length is not None:
-        constraints.append(f"Max Length: {type_obj.max_length}")
-    if hasattr(type_obj, 'patterns') and type_obj.patterns:
-         constraints.append(f"Pattern required")
-    
+    if type_obj.is_simple():
+        min_length = getattr(type_obj, 'min_length', None)
+        if min_length is not None:
+            constraints.append(f"Min Length: {min_length}")
+        max_length = getattr(type_obj, 'max_length', None)
+        if max_length is not None:
+            constraints.append(f"Max Length: {max_length}")
+        if getattr(type_obj, 'patterns', None):
+            constraints.append(f"Pattern required")
+
     return " | ".join(constraints) if constraints else ""
 
+def _documentation_text(doc):
+    """Text of one xs:documentation entry (a string or an lxml/ElementTree element)."""
+    if isinstance(doc, str):
+        return doc
+    return getattr(doc, 'text', str(doc))
+
+@_memoize_by_id("docs")
 def get_documentation(obj):
-    """Extract documentation from an XSD component."""
+    """Extract documentation from an XSD component. Returns a tuple of strings."""
     docs = []
-    
-    # helper to extract text safely
-    def extract_text(doc):
-        if isinstance(doc, str):
-            return doc
-        if hasattr(doc, 'text'):
-            return doc.text
-        # Fallback for lxml/ElementTree elements
-        return getattr(doc, 'text', str(doc))
-
     try:
-        if hasattr(obj, 'annotation') and obj.annotation is not None:
-             if hasattr(obj.annotation, 'documentation') and obj.annotation.documentation:
-                 for doc in obj.annotation.documentation:
-                     txt = extract_text(doc)
-                     if txt:
-                         docs.append(txt.strip())
+        annotation = getattr(obj, 'annotation', None)
+        documentation = getattr(annotation, 'documentation', None)
+        if documentation:
+            for doc in documentation:
+                txt = _documentation_text(doc)
+                if txt:
+                    docs.append(txt.strip())
     except Exception as e:
         print(f"Error extracting documentation: {e}")
         
-    return docs
+    return tuple(docs)
+
+# Input widget kinds of simple steps (see _WIDGET_RENDERERS)
+WIDGET_MULTISELECT = 'multiselect'
+WIDGET_SELECTBOX = 'selectbox'
+WIDGET_TOGGLE = 'toggle'
+WIDGET_TEXT = 'text'
 
-def render_input_fields(element, type_obj, parent_key, state_container, xml_path="", config_defaults=None, metadata=None, path_override=None, force_visible=False):
+@dataclass(frozen=True)
+class Step:
     """
-    Recursively renders input fields for an element.
-    Returns the value entered/selected by the user.
+    One node of a precomputed render plan. Plain data only: rendering a plan does
+    not touch xmlschema objects.
+    kind is 'simple' (input field), 'complex' (container of child steps) or
+    'choice' (required xs:choice; options are (label, Step or None) pairs,
+    option_labels their labels in the same order for the radio widget and
+    choice_by_label maps each label to its Step).
     """
-    indent_level = len(parent_key.split(".")) if parent_key else 0
-    # Use clean name for key generation to avoid duplicates or weird keys
-    elem_name_clean = element.name
+    kind: str
+    name: str = ""
+    local_name: str = ""
+    min_occurs: int = 1
+    max_occurs: int | None = 1
+    # Simple fields
+    enums: tuple | None = None
+    enum_index: dict | None = None  # enum value -> position in enums
+    widget: str = WIDGET_TEXT
+    max_chars: int | None = None
+    pattern_hint: tuple | None = None
+    min_length: int | None = None
+    white_space: str | None = None
+    help_text: str = ""
+    export_columns: dict | None = None  # Per-field Excel export columns fixed by the schema
+    # Complex elements
+    docs: tuple = ()
+    children: tuple | None = None
+    # Choices
+    choice_id: int = 0
+    options: tuple = ()
+    option_labels: tuple = ()
+    choice_by_label: dict | None = None
+
+# EUDAMED field codes embedded in the XSD documentation, e.g. "#FLD-UDID-12#"
+_FLD_RE = re.compile(r"#(FLD.*?)#")
+# List indices in XML paths (e.g. path/to/elem[0]); config keys are written without them
+_IDX_RE = re.compile(r'\[\d+\]')
+
+def _compile_simple(element, type_obj, metadata):
+    """Precompute everything needed to render a simple-typed element."""
+    is_mandatory = getattr(element, 'min_occurs', 1) >= 1
+
+    # Check for List Type (e.g. whitespace separated values)
+    is_list_type = getattr(type_obj, 'is_list', lambda: False)()
+
+    enums = get_enums_for_type(type_obj)
+    # If it is a list type, try to get enums from the item type
+    if not enums and is_list_type and hasattr(type_obj, 'item_type'):
+         enums = get_enums_for_type(type_obj.item_type)
+
+    # Handle optional Enum: Add empty option if not mandatory
+    if enums and not is_list_type and not is_mandatory:
+        if "" not in enums:
+            enums = ("",) + enums
+
+    # Build help text with documentation
+    help_lines = []
+
+    # 1. Try element annotation
+    element_docs = get_documentation(element)
+    if element_docs:
+        help_lines.extend(element_docs)
+
+    # 2. Try type annotation if element has none
+    if not element_docs:
+        type_docs = get_documentation(type_obj)
+        if type_docs:
+            help_lines.extend(type_docs)
+
+    # Extract FLD codes (most documentation has none, so skip the regex then)
+    temp_help_text = "\n".join(help_lines)
+    fld_codes = _FLD_RE.findall(temp_help_text) if '#FLD' in temp_help_text else []
+
+    # Fetch Metadata
+    meta_info = {}
+    if metadata and fld_codes:
+        for code in fld_codes:
+            if code in metadata:
+                row = metadata[code]
+                meta_info[code] = row
+                # Append info to help lines
+                help_lines.append(f"--- Metadata for {code} ---")
+                if row.get('Field Label'):
+                    help_lines.append(f"Label: {row['Field Label']}")
+                if row.get('Field Description / Notes'):
+                    help_lines.append(f"Description: {row['Field Description / Notes']}")
+                if row.get('Business Rules'):
+                    help_lines.append(f"Rules: {row['Business Rules']}")
+
+    help_lines.append(f"Namespace: {element.name}")
+
+    constraint_text = get_type_constraints_help(type_obj)
+    if constraint_text:
+        help_lines.append(f"Constraints: {constraint_text}")
+
+    is_bool = bool(hasattr(type_obj, 'primitive_type') and type_obj.primitive_type and type_obj.primitive_type.local_name == 'boolean')
+
+    # Pick the input widget once, so rendering is a single table lookup
+    if enums:
+        widget = WIDGET_MULTISELECT if is_list_type else WIDGET_SELECTBOX
+    elif is_bool:
+        widget = WIDGET_TOGGLE
+    else:
+        widget = WIDGET_TEXT
+
+    # Check for max length for the input widget
+    max_chars = None
+    if hasattr(type_obj, 'max_length') and type_obj.max_length is not None:
+        max_chars = int(type_obj.max_length)
+    # minLength is checked by the field hint; 1 only rules out empty values, which are not checked
+    min_length = getattr(type_obj, 'min_length', None)
+    if not min_length or min_length <= 1:
+        min_length = None
+
+    help_text = "\n\n".join(help_lines)
+
+    # XSD Occurrences and FLD codes for the Excel export
+    min_occurs = getattr(element, 'min_occurs', 1)
+    max_occurs = getattr(element, 'max_occurs', 1)
+    export_columns = {
+        'xsd_min': str(min_occurs),
+        'xsd_max': str(max_occurs) if max_occurs is not None else "unbounded",
+        'FLD_code': ", ".join(fld_codes) if fld_codes else "",
+        'tooltip': help_text,
+    }
+
+    # Aggregate all metadata columns in one pass over the matched rows.
+    # The fld_codes list determines which rows are relevant, and in which order.
+    if meta_info:
+        aggregated = {}
+        for code in fld_codes:
+            row = meta_info.get(code)
+            if row is None:
+                continue
+            for key, val_part in row.items():
+                # Skip unmatched columns (the only list values, under the None key) and empty cells
+                if key is not None and val_part:
+                    aggregated.setdefault(key, []).append(val_part)
+
+        # Join multiple values with semi-colon
+        # Let's keep all to see distribution
+        for key, values in aggregated.items():
+            export_columns[key] = "; ".join(values)
+
+    return Step(
+        'simple',
+        name=element.name,
+        local_name=element.local_name,
+        min_occurs=min_occurs,
+        max_occurs=max_occurs,
+        enums=tuple(enums) if enums else None,
+        enum_index={v: i for i, v in enumerate(enums)} if enums else None,
+        widget=widget,
+        max_chars=max_chars,
+        pattern_hint=get_pattern_hint(type_obj),
+        min_length=min_length,
+        white_space=getattr(type_obj, 'white_space', None),
+        help_text=help_text,
+        export_columns=export_columns,
+    )
+
+def _compile_element(element, metadata):
+    """Compile an element (and its whole subtree) into a Step."""
+    type_obj = element.type
+    if type_obj.is_simple():
+        return _compile_simple(element, type_obj, metadata)
+
+    # Try to get documentation for complex type
+    c_docs = get_documentation(element)
+    if not c_docs:
+         c_docs = get_documentation(type_obj)
+
+    group = type_obj.content
+    children = None
+    if isinstance(group, xmlschema.validators.XsdGroup) and group:
+        children = tuple(_compile_group(group, metadata))
+
+    return Step(
+        'complex',
+        name=element.name,
+        local_name=element.local_name,
+        min_occurs=element.min_occurs,
+        max_occurs=element.max_occurs,
+        docs=tuple(c_docs),
+        children=children,
+    )
+
+def _compile_group(group_particle, metadata):
+    """Compile a model group (Sequence/Choice) into a flat list of Steps."""
+    # If it's a Choice with minOccurs >= 1, the user must make a selection
+    if group_particle.model == 'choice' and group_particle.min_occurs >= 1:
+        options = []
+        for opt in group_particle.iter_model():
+            if isinstance(opt, xmlschema.validators.XsdElement):
+                options.append((opt.local_name, _compile_element(opt, metadata)))
+            else:
+                options.append(("Nested Group", None)) # Simplified for now
+        choice_by_label = {}
+        for label, opt_step in options:
+            if opt_step is not None:
+                choice_by_label.setdefault(label, opt_step)
+        return [Step('choice', choice_id=id(group_particle), options=tuple(options),
+                     option_labels=tuple(label for label, _ in options),
+                     choice_by_label=choice_by_label)]
+
+    # Sequence or Optional Choice: nested groups are flattened into the parent
+    steps = []
+    for particle in group_particle.iter_model():
+        if isinstance(particle, xmlschema.validators.XsdElement):
+            steps.append(_compile_element(particle, metadata))
+        elif isinstance(particle, xmlschema.validators.XsdGroup):
+            if particle.min_occurs >= 1:
+                steps.extend(_compile_group(particle, metadata))
+    return steps
+
+@st.cache_resource(show_spinner=False)
+def build_render_plan(element_name, _element, _metadata):
+    """
+    Walks the schema below an element once and returns its render plan.
+    Schema and metadata are cached resources, so the plan is built once per process.
+    """
+    return _compile_element(_element, _metadata)
+
+# Per-field (clean path, tooltip) keyed by (id(step), path); entries keep the step referenced
+_FIELD_META = _memo_table("field_meta")
+
+def _render_multiselect(step, key, default_val, widget_help):
+    """Multi-select for list types with enumerations."""
+    default_selections = []
+    if default_val:
+        # Split string by whitespace to get selected items
+        default_selections = str(default_val).split()
+        # Filter valid enums only to prevent errors
+        default_selections = [x for x in default_selections if x in step.enum_index]
+
+    selected = st.multiselect(step.local_name, options=step.enums, default=default_selections, key=key, help=widget_help)
+    # XML List types are space-separated strings
+    return " ".join(selected) if selected else None
+
+def _render_selectbox(step, key, default_val, widget_help):
+    """Selectbox for enumerations."""
+    # Handle index for default value in selectbox
+    default_idx = 0
+    if default_val:
+        default_idx = step.enum_index.get(str(default_val), 0)
+
+    val = st.selectbox(step.local_name, options=step.enums, index=default_idx, key=key, help=widget_help)
+
+    # If empty string selected/defaulted, return None so it is omitted from XML
+    return val if val != "" else None
+
+def _render_toggle(step, key, default_val, widget_help):
+    """Toggle for booleans."""
+    is_checked = False
+    if default_val is not None:
+        if isinstance(default_val, bool):
+            is_checked = default_val
+        elif str(default_val).lower() == 'true':
+            is_checked = True
+
+    bool_val = st.toggle(step.local_name, value=is_checked, key=key, help=widget_help)
+    return "true" if bool_val else "false"
+
+def _render_text(step, key, default_val, widget_help):
+    """Free text input."""
+    input_val = str(default_val) if default_val is not None else ""
+    return st.text_input(step.local_name, value=input_val, key=key, help=widget_help, max_chars=step.max_chars)
+
+_WIDGET_RENDERERS = {
+    WIDGET_MULTISELECT: _render_multiselect,
+    WIDGET_SELECTBOX: _render_selectbox,
+    WIDGET_TOGGLE: _render_toggle,
+    WIDGET_TEXT: _render_text,
+}
+
+def render_plan(step, parent_key, state_container, record, xml_path="", config_defaults=None, path_override=None, force_visible=False, record_path=()):
+    """
+    Renders input fields for a compiled plan step.
+    Values are written into the flat `record` dict, keyed by the tuple of
+    (qualified name, index) segments leading to the element (see build_xml_element_manual_tag).
+    The same keys map to (tooltip path, widget key) in state_container['field_widgets'],
+    so validation errors can be reported at the field they belong to (see locate_error).
+    """
+    key = f"{parent_key}.{step.local_name}" if parent_key else step.local_name
 
-    if hasattr(element, 'name') and element.name and '}' in element.name:
-        elem_name_clean = element.name.split('}')[-1]
-    
-    key = f"{parent_key}.{elem_name_clean}" if parent_key else elem_name_clean
-    
     if path_override:
         current_path = path_override
     else:
-        current_path = f"{xml_path}/{element.local_name}" if xml_path else element.local_name
-    
-    # Store the structure in session state to rebuild XML later
-    if 'xml_structure' not in state_container:
-        state_container['xml_structure'] = {}
+        current_path = f"{xml_path}/{step.local_name}" if xml_path else step.local_name
 
-    if type_obj.is_simple():
+    # Bound once: render_plan runs for every field of every UDI-DI on each rerun
+    kind = step.kind
+    meta_key = (id(step), current_path)
+
+    if kind == 'simple':
         # Configuration Visibility Check
-        is_mandatory = getattr(element, 'min_occurs', 1) >= 1
-        
-        # Handle indexed paths (e.g., path/to/elem[0])
-        clean_path_for_check = re.sub(r'\[\d+\]', '', current_path)
-        
+        is_mandatory = step.min_occurs >= 1
+
+        # Path-derived strings are the same on every rerun: compute them once per field
+        field_meta = _FIELD_META.get(meta_key)
+        if field_meta is None:
+            # Handle indexed paths (e.g., path/to/elem[0])
+            clean_path = _IDX_RE.sub('', current_path)
+            # Show the XML Path in the tooltip instead of a separate caption element
+            path_help = f"📍 Path: `{current_path}`"
+            field_meta = (step, clean_path, f"{path_help}\n\n{step.help_text}" if step.help_text else path_help)
+            _FIELD_META[meta_key] = field_meta
+        _, clean_path_for_check, widget_help = field_meta
+
         # Visibility based on presence in config_defaults keys (if config is active)
         is_visible = False
+        default_val = None
         if config_defaults is None:
             is_visible = True
         else:
-             if (current_path in config_defaults) or (clean_path_for_check in config_defaults) or force_visible or is_mandatory:
-                 is_visible = True
-        
-        # Default Value
-        default_val = None
-        if config_defaults:
-            default_val = config_defaults.get(current_path)
-            if default_val is None:
-                default_val = config_defaults.get(clean_path_for_check)
+            # UDI-DI entries and reruns share one plan, so each field is resolved only once
+            resolved_memo = config_defaults.resolved
+            resolved_key = (meta_key, force_visible)
+            resolved = resolved_memo.get(resolved_key)
+            if resolved is None:
+                if (current_path in config_defaults) or (clean_path_for_check in config_defaults) or force_visible or is_mandatory:
+                    is_visible = True
+
+                # Default Value
+                default_val = config_defaults.get(current_path)
+                if default_val is None:
+                    default_val = config_defaults.get(clean_path_for_check)
+                resolved_memo[resolved_key] = (is_visible, default_val)
+            else:
+                is_visible, default_val = resolved
 
         # Logic: If hidden, try to return default, else return None (skip)
-        
+
         if not is_visible:
             if default_val is not None:
-                return str(default_val)
+                record[record_path] = str(default_val)
+                # No widget: errors on the configured default point to its path only
+                state_container['field_widgets'][record_path] = (current_path, None)
             # If mandatory (min_occurs >= 1) but hidden and no default -> Warning? Or skip?
             # We skip it. Validation will catch it later if it was critical.
-            return None
-
-        # Check for List Type (e.g. whitespace separated values)
-        is_list_type = getattr(type_obj, 'is_list', lambda: False)()
+            return
 
-        enums = get_enums_for_type(type_obj)
-        # If it is a list type, try to get enums from the item type
-        if not enums and is_list_type and hasattr(type_obj, 'item_type'):
-             enums = get_enums_for_type(type_obj.item_type)
+        # Widget kind was classified when the plan was compiled
+        val = _WIDGET_RENDERERS[step.widget](step, key, default_val, widget_help)
+        state_container['field_widgets'][record_path] = (current_path, key)
 
-        # Handle optional Enum: Add empty option if not mandatory
-        if enums and not is_list_type and not is_mandatory:
-            if "" not in enums:
-                enums = [""] + enums
-
-        label = f"{element.local_name}"
-        
-        # Display XML Path
-        st.caption(f"📍 Path: `{current_path}`")
-        
-        # Build help text with documentation
-        help_lines = []
-        
-        # 1. Try element annotation
-        element_docs = get_documentation(element)
-        if element_docs:
-            help_lines.extend(element_docs)
-        
-        # 2. Try type annotation if element has none
-        if not element_docs:
-            type_docs = get_documentation(type_obj)
-            if type_docs:
-                help_lines.extend(type_docs)
-
-        # Extract FLD codes
-        temp_help_text = "\n".join(help_lines)
-        fld_codes = re.findall(r"#(FLD.*?)#", temp_help_text)
-        
-        # Fetch Metadata
-        meta_info = {}
-        if metadata and fld_codes:
-            for code in fld_codes:
-                if code in metadata:
-                    row = metadata[code]
-                    meta_info[code] = row
-                    # Append info to help lines
-                    help_lines.append(f"--- Metadata for {code} ---")
-                    if row.get('Field Label'):
-                        help_lines.append(f"Label: {row['Field Label']}")
-                    if row.get('Field Description / Notes'):
-                        help_lines.append(f"Description: {row['Field Description / Notes']}")
-                    if row.get('Business Rules'):
-                        help_lines.append(f"Rules: {row['Business Rules']}")
-        
-        help_lines.append(f"Namespace: {element.name}")
-        
-        constraint_text = get_type_constraints_help(type_obj)
-        if constraint_text:
-            help_lines.append(f"Constraints: {constraint_text}")
-            
-        help_text = "\n\n".join(help_lines)
-        
-        val = None
-        if enums:
-            if is_list_type:
-                # Handle Multi-Select for List Types
-                default_selections = []
-                if default_val:
-                    # Split string by whitespace to get selected items
-                    default_selections = str(default_val).split()
-                    # Filter valid enums only to prevent errors
-                    default_selections = [x for x in default_selections if x in enums]
-                
-                selected = st.multiselect(label, options=enums, default=default_selections, key=key, help=help_text)
-                # XML List types are space-separated strings
-                val = " ".join(selected) if selected else None
-            else:
-                # Handle index for default value in selectbox
-                default_idx = 0
-                if default_val and str(default_val) in enums:
-                    default_idx = enums.index(str(default_val))
-                    
-                val = st.selectbox(label, options=enums, index=default_idx, key=key, help=help_text)
-                
-                # If empty string selected/defaulted, return None so it is omitted from XML
-                if val == "":
-                    val = None
-        elif hasattr(type_obj, 'primitive_type') and type_obj.primitive_type and type_obj.primitive_type.local_name == 'boolean':
-             # Handle Boolean
-             # Default value check
-             is_checked = False
-             if default_val is not None:
-                 if isinstance(default_val, bool):
-                     is_checked = default_val
-                 elif str(default_val).lower() == 'true':
-                     is_checked = True
-            
-             bool_val = st.toggle(label, value=is_checked, key=key, help=help_text)
-             val = "true" if bool_val else "false"
-        else:
-            # Check for max length for the input widget
-            max_chars = None
-            if hasattr(type_obj, 'max_length') and type_obj.max_length is not None:
-                max_chars = int(type_obj.max_length)
-             
-            # Default value
-            input_val = str(default_val) if default_val is not None else ""
-                
-            val = st.text_input(label, value=input_val, key=key, help=help_text, max_chars=max_chars)
-        
         # Validation Logic
         if val:
-            # Use xmlschema's own validation to check the value
-            try:
-                type_obj.validate(val)
-            except xmlschema.XMLSchemaValidationError as e:
-                st.error(f"❌ Invalid format: {e.reason}")
-            except Exception as e:
-                st.error(f"❌ Invalid value")
-            
+            # Only a cheap pattern hint here; the schema validates the generated XML on submit.
+            # Results are memoized per (facets, value), so unchanged values are not rechecked.
+            err = check_pattern_hint(step, val)
+            if err:
+                st.error(err)
+
             # Record data for CSV Export
-            fld_code_str = ", ".join(fld_codes) if fld_codes else ""
-            
-            # XSD Occurrences
-            min_o = getattr(element, 'min_occurs', '1')
-            max_o = getattr(element, 'max_occurs', '1')
-            if max_o is None: max_o = "unbounded"
-
-            # Base entry
-            csv_entry = {
-                'XMLPath': current_path,
-                'value': val,
-                'xsd_min': str(min_o),
-                'xsd_max': str(max_o),
-                'FLD_code': fld_code_str,
-                'tooltip': help_text
-            }
-            
-            # Aggregate all metadata columns
-            # We want to check ALL headers that might exist in the collected rows
-            if meta_info:
-                # Collect all column names found in the matched rows
-                found_keys = set()
-                for row in meta_info.values():
-                    found_keys.update(row.keys())
-                
-                for key in found_keys:
-                    if key is None: continue # Skip 'restkey' or unmatched columns
-                    
-                    values = []
-                    # We iterate over fld_codes to preserve some order or logic?
-                    # Or just iterate over meta_info items?
-                    # The fld_codes list determines which rows are relevant.
-                    for code in fld_codes:
-                        if code in meta_info:
-                            val_part = meta_info[code].get(key, '')
-                            if val_part: 
-                                if isinstance(val_part, list):
-                                    values.append(",".join(map(str, val_part)))
-                                else:
-                                    values.append(str(val_part))
-                    
-                    if values:
-                        # Join multiple values with semi-colon
-                        # Avoid duplicating if same value exists? 
-                        # Let's keep all to see distribution
-                        csv_entry[key] = "; ".join(values)
-            
-            if 'csv_entries' not in state_container:
-                state_container['csv_entries'] = []
-            
-            state_container['csv_entries'].append(csv_entry)
+            # (XMLPath, value, columns): the columns that only depend on the schema
+            # (including the aggregated metadata columns) were built with the plan and
+            # are shared, so nothing is merged per field; the export expands the rows
+            state_container.setdefault('csv_entries', []).append((current_path, val, step.export_columns))
+
+        if val is not None:
+            record[record_path] = val
+
+    elif kind == 'complex':
+        # One markdown element per container: path and documentation go into its tooltip,
+        # as for the input fields, instead of a caption element per line
+        field_meta = _FIELD_META.get(meta_key)
+        if field_meta is None:
+            help_lines = [f"📍 Path: `{current_path}`"] + [f"ℹ️ {d}" for d in step.docs]
+            field_meta = (step, None, "\n\n".join(help_lines))
+            _FIELD_META[meta_key] = field_meta
+        st.markdown(f"**{step.local_name}**", help=field_meta[2])
+        # Errors on the container itself (e.g. a missing child) point to its heading
+        state_container['field_widgets'][record_path] = (current_path, None)
+
+        if not step.children:
+            return
 
-        return val
+        # The top level content of a complex type is a Group (usually sequence)
+        process_group(step.children, key, current_path, 0, state_container, config_defaults, record, record_path)
+
+def process_group(steps, parent_key, current_path, indent_level, state_container, cd, record, record_path):
+    """Renders the compiled steps of a model group into the flat record below record_path."""
+    for step in steps:
+        if step.kind == 'choice':
+            process_choice(step, parent_key, current_path, indent_level, state_container, cd, record, record_path)
+            continue
+
+        # Bind the step attributes read repeatedly below
+        local_name = step.local_name
+        min_occurs = step.min_occurs
+        max_occurs = step.max_occurs
+
+        # Determine visibility: Mandatory OR Configured (Visible/Default)
+        clean_path = f"{current_path}/{local_name}" if current_path else local_name
+
+        # Normalize path for checking configuration (remove indices)
+        clean_path_no_idx = _IDX_RE.sub('', clean_path) if '[' in clean_path else clean_path
+
+        # Check for repeated element
+        is_repeated = max_occurs is None or max_occurs > 1
+
+        # Visibility Check:
+        # 1. Exact match in config
+        # 2. Key prefix match (if children are configured, parent must be visible)
+        # Both only depend on the configuration, so they are resolved once per path.
+        if cd is None:
+            is_configured_clean, indexed_count = True, 0
+        else:
+            layout_key = (id(step), clean_path)
+            layout = cd.group_layout.get(layout_key)
+            if layout is None:
+                is_in_config = (clean_path in cd or clean_path_no_idx in cd
+                                # Prefix Check (are there visible children?)
+                                or cd.has_children(clean_path_no_idx))
+
+                # Indexed defaults determine the initial count (e.g. key "Path[1]").
+                # Default keys are LEAF level full paths ("Push/payload/MDRDevice/..."),
+                # while clean_path might be intermediate (complex), e.g. "A/B" with key "A/B[0]/C".
+                indexed_count = cd.list_count(clean_path) if is_repeated else 0
+
+                layout = (is_in_config, indexed_count)
+                cd.group_layout[layout_key] = layout
+            is_configured_clean, indexed_count = layout
+
+        if is_repeated:
+            # Default count Logic
+            count = min_occurs
+
+            if cd:
+                if indexed_count > count:
+                    count = indexed_count
+
+                # 'is_configured_clean' is true if children are visible:
+                # show at least one item even if no default value is set.
+                if is_configured_clean and count == 0:
+                     count = 1
+
+            # Ensure we show if any index is configured or clean path is configured
+            if min_occurs >= 1 or is_configured_clean or count > 0:
+                st.markdown(f"{'  ' * indent_level}**{local_name} (List)**")
+                count_key = f"{parent_key}_{local_name}_count"
+                count_val = st.number_input(f"Number of {local_name} entries", min_value=min_occurs, value=count, key=count_key)
+
+                for i in range(count_val):
+                    with st.expander(f"{local_name} #{i+1}", expanded=False):
+                        indexed_path = f"{clean_path}[{i}]"
+                        # The index keeps repeated siblings apart in the record (qualified name)
+                        render_plan(
+                            step,
+                            f"{parent_key}_{i}",
+                            state_container,
+                            record,
+                            xml_path=None,
+                            config_defaults=cd,
+                            path_override=indexed_path,
+                            record_path=record_path + ((step.name, i),)
+                        )
 
-    elif type_obj.is_complex():
-        label = f"**{element.local_name}**"
-        
-        # Try to get documentation for complex type
-        c_help_lines = []
-        c_docs = get_documentation(element)
-        if not c_docs:
-             c_docs = get_documentation(type_obj)
-        
-        if c_docs:
-            # We can't put help on markdown, so we render an info box or caption if docs exist
-            st.markdown(label)
-            for d in c_docs:
-                st.caption(f"ℹ️ {d}")
         else:
-            st.markdown(label)
-            
-        st.caption(f"Path: `{current_path}`")
-        
-        group = type_obj.content
-        if not group: 
-            return None
+            if min_occurs >= 1 or is_configured_clean:
+               with st.container():
+                   col1, col2 = st.columns([0.5, 9.5])
+                   with col2:
+                       # Store with qualified name
+                       render_plan(
+                           step,
+                           parent_key,
+                           state_container,
+                           record,
+                           current_path,
+                           cd,
+                           record_path=record_path + ((step.name, None),)
+                       )
+
+def process_choice(step, parent_key, current_path, indent_level, state_container, cd, record, record_path):
+    """Renders a required Choice: the user (or the configuration) selects exactly one option."""
+    # Unique key for this choice
+    choice_key = f"{parent_key}_choice_{step.choice_id}"
+
+    # Auto-selection logic based on visibility config
+    default_idx = 0
+    forced_choice = False
+
+    if cd:
+        layout_key = (id(step), current_path)
+        layout = cd.group_layout.get(layout_key)
+        if layout is None:
+            visible_candidates = []
+            for idx, (_, opt) in enumerate(step.options):
+                if opt is not None:
+                    opt_path = f"{current_path}/{opt.local_name}"
+
+                    # Check precise match or if it's a prefix for other visible fields
+                    # (e.g. modelName vs modelName/name)
+                    if opt_path in cd or cd.has_children(opt_path):
+                        visible_candidates.append(idx)
+
+            # If exactly one option is configured to be visible, pick it
+            if len(visible_candidates) == 1:
+                layout = (visible_candidates[0], True)
+            else:
+                layout = (0, False)
+            cd.group_layout[layout_key] = layout
+        default_idx, forced_choice = layout
 
-        children_data = {}
-        
-        # Helper to process model groups (Sequence/Choice)
-        def process_group(group_particle, parent_key, current_path, indent_level, cd, md):
-             group_data = {}
-             
-             # If it's a Choice with minOccurs >= 1, we must force a made selection
-             if group_particle.model == 'choice' and group_particle.min_occurs >= 1:
-                 # Get options
-                 options = [p for p in group_particle.iter_model()]
-                 # Create labels for options (using local_name if element, else 'Group')
-                 option_labels = []
-                 for opt in options:
-                     if isinstance(opt, xmlschema.validators.XsdElement):
-                         option_labels.append(opt.local_name)
-                     else:
-                         option_labels.append("Nested Group") # Simplified for now
-                 
-                 # Unique key for this choice
-                 choice_key = f"{parent_key}_choice_{id(group_particle)}"
-                 
-                 # Auto-selection logic based on visibility config
-                 default_idx = 0
-                 forced_choice = False
-                 
-                 if cd:
-                     visible_candidates = []
-                     for idx, opt in enumerate(options):
-                         if isinstance(opt, xmlschema.validators.XsdElement):
-                             opt_path = f"{current_path}/{opt.local_name}"
-                             
-                             # Check precise match or if it's a prefix for other visible fields
-                             # (e.g. modelName vs modelName/name)
-                             is_visible = False
-                             if opt_path in cd:
-                                 is_visible = True
-                             else:
-                                 # Prefix Check
-                                 prefix = opt_path + "/"
-                                 if any(k.startswith(prefix) for k in cd):
-                                     is_visible = True
-                                     
-                             if is_visible:
-                                 visible_candidates.append(idx)
-                     
-                     # If exactly one option is configured to be visible, pick it
-                     if len(visible_candidates) == 1:
-                         default_idx = visible_candidates[0]
-                         forced_choice = True
-                         
-                 # --- SELECTION LOGIC ---
-                 selected_particle = None
-                 
-                 if not forced_choice:
-                     st.markdown(f"{'  ' * indent_level}*Choose one required option:*")
-                     selected_label = st.radio("Select type:", option_labels, index=default_idx, key=choice_key, horizontal=True, label_visibility="collapsed")
-                     
-                     for opt in options:
-                         if isinstance(opt, xmlschema.validators.XsdElement) and opt.local_name == selected_label:
-                             selected_particle = opt
-                             break
-                 else:
-                     # Explicitly grab the forced option
-                     if 0 <= default_idx < len(options):
-                        selected_particle = options[default_idx]
-                     else:
-                        st.error(f"Index error in forced choice: {default_idx} vs len {len(options)}")
-                 
-                 if selected_particle is not None:
-                      # Process the selected branch
-                      
-                      if isinstance(selected_particle, xmlschema.validators.XsdElement):
-                           if forced_choice:
-                                # Using standard layout but forcing visibility
-                                # Explicitly calling render_input_fields
-                                
-                                with st.container():
-                                     # Use columns to align with peers (match the visual indentation)
-                                     col1, col2 = st.columns([0.5, 9.5])
-                                     with col2:
-                                         val = render_input_fields(
-                                            selected_particle, 
-                                            selected_particle.type, 
-                                            parent_key, 
-                                            state_container, 
-                                            current_path,
-                                            cd, md,
-                                            path_override=None,
-                                            force_visible=True
-                                        )
-                                # Store result
-                                group_data[selected_particle.name] = val
-                           else:
-                               with st.container():
-                                    col1, col2 = st.columns([0.5, 9.5])
-                                    with col2:
-                                        # Recursive call
-                                        val = render_input_fields(
-                                            selected_particle, 
-                                            selected_particle.type, 
-                                            parent_key, 
-                                            state_container, 
-                                            current_path,
-                                            cd, md
-                                        )
-                                        # Ensure we store it even if it's None (but usually None is skipped)
-                                        # Use qualified name for correct namespace mapping
-                                        group_data[selected_particle.name] = val
-             
-             # If Sequence or Optional Choice (though optional choice usually doesn't force input)
-             else:
-                 for particle in group_particle.iter_model():
-                     if isinstance(particle, xmlschema.validators.XsdElement):
-                         # Determine visibility: Mandatory OR Configured (Visible/Default)
-                         clean_path = f"{current_path}/{particle.local_name}" if current_path else particle.local_name
-                         child_path = clean_path # default to clean path for check
-                         
-                         # Normalize path for checking configuration (remove indices)
-                         clean_path_no_idx = re.sub(r'\[\d+\]', '', clean_path)
-                         
-                         # Visibility Check:
-                         # 1. Exact match in config
-                         # 2. Key prefix match (if children are configured, parent must be visible)
-                         
-                         is_in_config = False
-                         if cd is None:
-                             is_in_config = True
-                         else:
-                             if clean_path in cd or clean_path_no_idx in cd:
-                                 is_in_config = True
-                             else:
-                                 # Prefix Check (are there visible children?)
-                                 prefix = clean_path_no_idx + "/"
-                                 if any(k.startswith(prefix) for k in cd):
-                                     is_in_config = True
-                         
-                         is_configured_clean = is_in_config
-                         
-                         # Check for repeated element
-                         is_repeated = particle.max_occurs is None or particle.max_occurs > 1
-                         
-                         if is_repeated:
-                             # Default count Logic
-                             count = particle.min_occurs
-                             
-                             # Check for indexed defaults to determine initial count (e.g. key "Path[1]")
-                             if cd:
-                                 idx = 0
-                                 found_index = True
-                                 while found_index:
-                                     # We need to scan keys because they are fully qualified paths
-                                     # Optimized check: try to find any key containing "{clean_path}[{idx}]"
-                                     # Since keys are typically "Path/To/Leaf", checking exact prefix is safer.
-                                     # But default keys are LEAF level. clean_path might be intermediate (complex).
-                                     # If clean_path is "A/B", and we have "A/B[0]/C: val"
-                                     prefix = f"{clean_path}[{idx}]"
-                                     # Need to check against absolute keys in defaults
-                                     # Note: 'cd' keys are usually full paths. 'clean_path' is full path so far.
-                                     # But check if suffix matches? 
-                                     # The keys in defaults are "MDRDevice/..."
-                                     # content of 'clean_path' is "MDRDevice/..." (current path joined)
-                                     
-                                     # Check for exact prefix match in defaults keys
-                                     # Check if any key starts with prefix
-                                     found_start = False
-                                     combined_prefix = prefix + "/"
-                                     if any(k.startswith(combined_prefix) or k == prefix for k in cd.keys()):
-                                         found_start = True
-                                     
-                                     if found_start:
-                                         if (idx + 1) > count:
-                                             count = idx + 1
-                                         idx += 1
-                                     else:
-                                         found_index = False
-                                 
-                                 # Check if specific fields inside the list item are visible (CV)
-                                 # (handle case where no default value is set but field is visible)
-                                 # If visible_fields has "Path/Item/Field", we should at least show 1 item?
-                                 # Current logic: 'is_configured_clean' is true if children are visible.
-                                 if is_configured_clean and count == 0:
-                                      count = 1
-
-                             # Ensure we show if any index is configured or clean path is configured
-                             if particle.min_occurs >= 1 or is_configured_clean or count > 0:
-                                 st.markdown(f"{'  ' * indent_level}**{particle.local_name} (List)**")
-                                 count_key = f"{parent_key}_{particle.local_name}_count"
-                                 count_val = st.number_input(f"Number of {particle.local_name} entries", min_value=particle.min_occurs, value=count, key=count_key)
-                                 
-                                 vals = []
-                                 for i in range(count_val):
-                                     with st.expander(f"{particle.local_name} #{i+1}", expanded=False):
-                                         indexed_path = f"{clean_path}[{i}]"
-                                         child_val = render_input_fields(
-                                            particle, 
-                                            particle.type, 
-                                            f"{parent_key}_{i}", 
-                                            state_container, 
-                                            xml_path=None,
-                                            config_defaults=cd, 
-                                            metadata=md,
-                                            path_override=indexed_path
-                                         )
-                                         if child_val is not None:
-                                             vals.append(child_val)
-                                 if vals:
-                                     # Store with qualified name
-                                     group_data[particle.name] = vals
-
-                         else:
-                             if particle.min_occurs >= 1 or is_configured_clean:
-                                with st.container():
-                                    col1, col2 = st.columns([0.5, 9.5])
-                                    with col2:
-                                        child_val = render_input_fields(
-                                            particle, 
-                                            particle.type, 
-                                            parent_key, 
-                                            state_container, 
-                                            current_path,
-                                            cd, md
-                                        )
-                                        if child_val is not None:
-                                            # Store with qualified name
-                                            group_data[particle.name] = child_val
-                     
-                     elif isinstance(particle, xmlschema.validators.XsdGroup):
-                         if particle.min_occurs >= 1:
-                             # Recurse for nested group
-                             nested_data = process_group(particle, parent_key, current_path, indent_level, cd, md)
-                             group_data.update(nested_data)
-                             
-             return group_data
-
-        # Start processing the top-level group
-        # The top level content of a complex type is a Group (usually sequence)
-        children_data = process_group(group, key, current_path, 0, config_defaults, metadata)
-        
-        if not children_data: return None
-        return children_data
+    # --- SELECTION LOGIC ---
+    selected_step = None
 
-def build_xml_element(element_name, xsd_type, form_data):
-    """Recursively builds an ElementTree element from the dictionary form data."""
-    tag = element_name
-    elem = ET.Element(tag)
-    
-    if isinstance(form_data, dict):
-        for child_tag, child_val in form_data.items():
-            if child_val is None: continue 
-
-            # Handle List of values (maxOccurs > 1)
-            if isinstance(child_val, list):
-                for item in child_val:
-                    if isinstance(item, (str, dict)):
-                         child_elem = build_xml_element_manual_tag(child_tag, item)
-                         elem.append(child_elem)
-            elif isinstance(child_val, (str, dict)):
-                child_elem = build_xml_element_manual_tag(child_tag, child_val)
-                elem.append(child_elem)
-    
-    elif isinstance(form_data, str):
-        elem.text = form_data
-        
-    return elem
+    if not forced_choice:
+        st.markdown(f"{'  ' * indent_level}*Choose one required option:*")
+        selected_label = st.radio("Select type:", step.option_labels, index=default_idx, key=choice_key, horizontal=True, label_visibility="collapsed")
+        selected_step = step.choice_by_label.get(selected_label)
+    else:
+        # Explicitly grab the forced option
+        selected_step = step.options[default_idx][1]
+
+    if selected_step is not None:
+        # Process the selected branch, forcing visibility if the configuration picked it
+        with st.container():
+            # Use columns to align with peers (match the visual indentation)
+            col1, col2 = st.columns([0.5, 9.5])
+            with col2:
+                # Use qualified name for correct namespace mapping
+                render_plan(
+                    selected_step,
+                    parent_key,
+                    state_container,
+                    record,
+                    current_path,
+                    cd,
+                    force_visible=forced_choice,
+                    record_path=record_path + ((selected_step.name, None),)
+                )
+
+def qualify_child_tag(child_tag):
+    """
+    Applies the correct namespace to an unqualified child tag.
+    This is tricky without the full schema context, so we look at the key name itself:
+    - Common Device fields -> 'commondi'
+    - Basic UDI specific -> 'basicudi'
+    - UDI-DI specific -> 'udidi'
+    - Market Info -> 'marketinfo'
+    - Links -> 'links'
+    """
+    # If child_tag is already qualified {uri}name, leave it.
+    if child_tag.startswith('{'):
+        return child_tag
+
+    # Try to map based on known field names
+    if child_tag in ['riskClass', 'model', 'humanTissuesCells', 'animalTissuesCells', 
+                     'humanProductCheck', 'IIb_implantable_exceptions', 'medicinalProductCheck',
+                     'type', 'MFActorCode', 'deviceCertificateLinks']:
+         return NS['basicudi'] + child_tag
+    elif child_tag in ['identifier', 'status', 'basicUDIIdentifier', 'MDNCodes', 
+                       'productionIdentifier', 'referenceNumber', 'sterile', 'sterilization',
+                       'numberOfReuses', 'marketInfos', 'baseQuantity', 'latex', 'reprocessed']:
+         return NS['udidi'] + child_tag
+    elif child_tag in ['DICode', 'issuingEntityCode', 'active', 'administeringMedicine', 
+                       'implantable', 'measuringFunction', 'reusable', 'code']:
+         return NS['commondi'] + child_tag
+    elif child_tag in ['deviceCertificateLink', 'certificateNumber', 'NBActorCode', 'certificateType']:
+         return NS['links'] + child_tag
+    elif child_tag in ['marketInfo', 'country', 'originalPlacedOnTheMarket']:
+         return NS['marketinfo'] + child_tag
+    return child_tag
 
 def build_xml_element_manual_tag(tag, content):
-    elem = ET.Element(tag)
-    if isinstance(content, dict):
-        # We need to apply correct namespaces to children based on where they belong.
-        # This is tricky without the full schema context at this level.
-        # Heuristic: 
-        # - Common Device fields -> 'commondi'
-        # - Basic UDI specific -> 'basicudi'
-        # - UDI-DI specific -> 'udidi'
-        # - Market Info -> 'marketinfo'
-        # - Links -> 'links'
-        
-        # Or, we can look at the key name itself.
-        for child_tag, child_val in content.items():
-            if child_val is None: continue
-            
-            # Determine namespace for child_tag if not present
-            final_tag = child_tag
-            
-            # If child_tag is already qualified {uri}name, leave it.
-            if not child_tag.startswith('{'):
-                # Try to map based on known field names
-                if child_tag in ['riskClass', 'model', 'humanTissuesCells', 'animalTissuesCells', 
-                                 'humanProductCheck', 'IIb_implantable_exceptions', 'medicinalProductCheck',
-                                 'type', 'MFActorCode', 'deviceCertificateLinks']:
-                     final_tag = f"{{{namespaces['basicudi']}}}{child_tag}"
-                elif child_tag in ['identifier', 'status', 'basicUDIIdentifier', 'MDNCodes', 
-                                   'productionIdentifier', 'referenceNumber', 'sterile', 'sterilization',
-                                   'numberOfReuses', 'marketInfos', 'baseQuantity', 'latex', 'reprocessed']:
-                     final_tag = f"{{{namespaces['udidi']}}}{child_tag}"
-                elif child_tag in ['DICode', 'issuingEntityCode', 'active', 'administeringMedicine', 
-                                   'implantable', 'measuringFunction', 'reusable', 'code']:
-                     final_tag = f"{{{namespaces['commondi']}}}{child_tag}"
-                elif child_tag in ['deviceCertificateLink', 'certificateNumber', 'NBActorCode', 'certificateType']:
-                     final_tag = f"{{{namespaces['links']}}}{child_tag}"
-                elif child_tag in ['marketInfo', 'country', 'originalPlacedOnTheMarket']:
-                     final_tag = f"{{{namespaces['marketinfo']}}}{child_tag}"
-            
-            if isinstance(child_val, list):
-                for item in child_val:
-                     child_elem = build_xml_element_manual_tag(final_tag, item)
-                     elem.append(child_elem)
-            else:
-                child_elem = build_xml_element_manual_tag(final_tag, child_val)
-                elem.append(child_elem)
-    else:
-        elem.text = str(content)
-    return elem
+    """Builds an ElementTree element from a flat form record (see stream_record)."""
+    tb = ET.TreeBuilder()
+    stream_record(tb, tag, content)
+    return tb.close()
+
+def stream_record(tb, tag, content):
+    """
+    Streams a flat form record into a TreeBuilder as a `tag` element.
+    Keys are tuples of (qualified name, index) segments in document order, values are
+    the leaf texts. Consecutive keys share their open ancestors, so each step only
+    closes and opens the segments where the paths differ. No intermediate elements are
+    looked up or appended from Python, and several records can share one builder.
+    """
+    tb.start(tag, {})
+    open_path = []
+    open_tags = []
+    for path, text in content.items():
+        # Length of the ancestor chain shared with the previous leaf
+        common = 0
+        limit = min(len(open_path), len(path) - 1)
+        while common < limit and open_path[common] == path[common]:
+            common += 1
+        while len(open_tags) > common:
+            tb.end(open_tags.pop())
+        del open_path[common:]
+
+        for segment in path[common:]:
+            child_tag = qualify_child_tag(segment[0])
+            tb.start(child_tag, {})
+            open_path.append(segment)
+            open_tags.append(child_tag)
+        tb.data(str(text))
+    while open_tags:
+        tb.end(open_tags.pop())
+    tb.end(tag)
+
+def to_form_path(error_path):
+    """
+    Strips the prefixes from a validation error path (e.g. /m:Push/m:header/s:partyID
+    becomes Push/header/partyID). Used for errors outside of the form records, which
+    have no tooltip path (see locate_error).
+    """
+    if not error_path:
+        return ""
+    return "/".join(part.split(":", 1)[-1] for part in error_path.strip("/").split("/"))
+
+# Element positions are tuples of (local name, 1-based position among same-named siblings)
+_PAYLOAD_POSITION = (("Push", 1), ("payload", 1))
+# One path step: prefixed or {uri} qualified name (xmlschema uses the latter for undeclared
+# prefixes), then an optional XPath index
+_ERROR_PATH_STEP = re.compile(r'/(?:\{[^}]*\}|[^/:\[\]{}]+:)?([^/:\[\]{}]+)(?:\[(\d+)\])?')
+
+def error_path_position(error_path):
+    """
+    Splits a validation error path (e.g. /m:Push/m:payload/device:UDIDIData[2]/udidi:status)
+    into an element position. Steps without an index are the only sibling of that name.
+    Returns None for paths in any other notation.
+    """
+    position = []
+    offset = 0
+    while offset < len(error_path):
+        match = _ERROR_PATH_STEP.match(error_path, offset)
+        if match is None:
+            return None
+        position.append((match.group(1), int(match.group(2) or 1)))
+        offset = match.end()
+    return tuple(position)
+
+def record_positions(record):
+    """
+    Maps the position of each element a record streams (see stream_record), relative to
+    the record element, to the record key prefix the element was opened for.
+    Positions are counted from what is actually streamed, so they match the XML even
+    where a list entry without any value left no element behind.
+    """
+    positions = {}
+    open_path = ()
+    open_position = ()
+    # Children opened so far below each open element, the record element first
+    sibling_counts = [{}]
+    for path in record:
+        common = 0
+        limit = min(len(open_path), len(path) - 1)
+        while common < limit and open_path[common] == path[common]:
+            common += 1
+        del sibling_counts[common + 1:]
+
+        position = list(open_position[:common])
+        for depth in range(common, len(path)):
+            local_name = path[depth][0].rsplit('}', 1)[-1]
+            counts = sibling_counts[depth]
+            counts[local_name] = counts.get(local_name, 0) + 1
+            position.append((local_name, counts[local_name]))
+            sibling_counts.append({})
+            positions[tuple(position)] = path[:depth + 1]
+        open_path = path
+        open_position = tuple(position)
+    return positions
+
+def index_record_sources(record_sources):
+    """Indexes (element position, record, widget map, label) tuples by element position."""
+    return {position: (record_positions(record), widgets, label)
+            for position, record, widgets, label in record_sources}
+
+def locate_error(error_path, source_index):
+    """
+    Finds the form field a validation error belongs to, given index_record_sources output.
+    Returns (tooltip path, widget key, record label), or None for errors outside of the
+    form records (envelope header fields). Errors on elements without a widget of their
+    own, such as a missing child, resolve to the nearest rendered container, whose
+    widget key is None.
+    """
+    position = error_path_position(error_path) if error_path else None
+    if not position:
+        return None
+    for depth in range(len(position), 0, -1):
+        source = source_index.get(position[:depth])
+        if source is None:
+            continue
+        positions, widgets, label = source
+        rest = position[depth:]
+        while True:
+            record_key = positions.get(rest) if rest else ()
+            field = widgets.get(record_key) if record_key is not None else None
+            if field is not None:
+                return field[0], field[1], label
+            if not rest:
+                return None
+            rest = rest[:-1]
+    return None
+
+def format_error(error_path, reason, source_index):
+    """Formats a validation error as a list item at the tooltip path of its field."""
+    located = locate_error(error_path, source_index)
+    if located is None:
+        return f"- `{to_form_path(error_path)}`: {reason}"
+    tooltip_path, _, label = located
+    return f"- `{tooltip_path}` ({label}): {reason}"
+
+@st.cache_resource(show_spinner=False)
+def build_envelope_skeleton():
+    """
+    Builds the fixed part of the Push envelope (header, recipient, empty payload, sender)
+    with empty texts. The cached element is shared: callers must deepcopy it before filling it in.
+    """
+    root = ET.Element(M['Push'])
+    root.set(NS['xsi'] + "schemaLocation",
+             f"{namespaces['m']} https://webgate.ec.europa.eu/tools/eudamed/dtx/service/Message.xsd")
+    root.set("version", "3.0.25")
+
+    ET.SubElement(root, M['correlationID'])
+    ET.SubElement(root, M['creationDateTime'])
+    ET.SubElement(root, M['messageID'])
+
+    # Recipient and sender share the same node/service layout
+    def add_party(tag):
+        party = ET.SubElement(root, M[tag])
+        node = ET.SubElement(party, M['node'])
+        ET.SubElement(node, S['nodeActorCode'])
+        service = ET.SubElement(party, M['service'])
+        ET.SubElement(service, S['serviceID'])
+        ET.SubElement(service, S['serviceOperation'])
+
+    add_party("recipient")
+    ET.SubElement(root, M['payload'])
+    add_party("sender")
+    return root
+
+def declare_output_namespaces(root):
+    """
+    Declares the output prefixes on the lxml envelope root. Payload subtrees are built
+    detached and carry their own xmlns declarations; they are hoisted to the root.
+    device/udidi are only referenced inside xsi:type values, so those prefixes stay
+    declared even when no tag uses them; libxml2 cannot resolve the QNames otherwise.
+    Idempotent, so validation and serialization can each call it in any order.
+    """
+    ET.cleanup_namespaces(root, top_nsmap=_OUTPUT_NSMAP, keep_ns_prefixes=['device', 'udidi'])
+
+# ElementTree writes empty elements as "<tag />"
+_EMPTY_TAG_SPACE = re.compile(r'(<[^<>]*) />')
+
+def serialize_envelope(root, pretty=True):
+    """
+    Serializes the envelope to UTF-8 bytes with an XML declaration, pretty-printed
+    unless pretty is False (indentation is cosmetic; EUDAMED accepts compact XML).
+    The Service namespace is written with the ns2 prefix EUDAMED uses in its examples.
+    With lxml this is a single C-level pass; otherwise the stdlib tree is indented
+    in place and the prefix is renamed in the text.
+    """
+    if HAS_LXML:
+        declare_output_namespaces(root)
+        # lxml writes an empty-string text as <x></x>; drop it so empty fields stay <x/>
+        for elem in root.iter():
+            if elem.text == "":
+                elem.text = None
+        return ET.tostring(root, xml_declaration=True, encoding="utf-8", pretty_print=pretty)
+
+    # ET.indent only adds whitespace between child elements, so no reparse is needed
+    if pretty:
+        ET.indent(root, space="  ")
+    text = '<?xml version="1.0" encoding="utf-8"?>\n' + ET.tostring(root, encoding="unicode")
+    if pretty:
+        text += '\n'
+    # ElementTree writes '<x />'; use '<x/>' as the lxml path does. '<' and '>' are escaped everywhere but in tags
+    text = _EMPTY_TAG_SPACE.sub(r'\1/>', text)
+    # ElementTree reserves ns<digits> prefixes, so ns2 can only be set on the text
+    text = text.replace('xmlns:s=', 'xmlns:ns2=')
+    text = text.replace('<s:', '<ns2:')
+    text = text.replace('</s:', '</ns2:')
+    return text.encode("utf-8")
+
+# libxml2 prefixes each message with the element's expanded name, which the path already shows
+_LXML_ELEMENT_PREFIX = re.compile(r"^Element '[^']*': ")
+
+def validate_envelope(root):
+    """
+    Validates the envelope tree in memory and returns (path, reason) for each error.
+    Uses libxml2 when available, which is many times faster than xmlschema.
+    """
+    lxml_schema = load_lxml_schema()
+    if lxml_schema is not None:
+        validator, lock = lxml_schema
+        # xsi:type QNames need their prefixes in scope, whether or not the tree was serialized yet
+        declare_output_namespaces(root)
+        with lock:
+            validator.validate(root)
+            return [(err.path, _LXML_ELEMENT_PREFIX.sub('', err.message)) for err in validator.error_log]
+
+    # namespaces resolves the prefixes used in xsi:type values
+    return [(err.path, err.reason) for err in schema.iter_errors(root, namespaces=namespaces)]
 
 # --- Database Integration Functions ---
 
@@ -750,6 +1258,7 @@ def get_db_engine():
         return None
 
     try:
+        from sqlalchemy import create_engine
         connection_string = f"oracle+oracledb://{db_user}:{db_password}@{db_alias}"
         engine = create_engine(connection_string)
         return engine
@@ -782,6 +1291,7 @@ def fetch_ifs_data(model, pcode):
     """
     
     try:
+        import pandas as pd
         with engine.connect() as conn:
             df = pd.read_sql(query, conn)
         return df
@@ -799,8 +1309,7 @@ if not schema:
     st.stop()
 
 # --- Logo & Configuration ---
-base_dir = os.path.dirname(os.path.abspath(__file__))
-logo_path = os.path.join(base_dir, '.streamlit', 'EUDAMED_logo.jpg')
+logo_path = os.path.join(_BASE_DIR, '.streamlit', 'EUDAMED_logo.jpg')
 if os.path.exists(logo_path):
     st.sidebar.image(logo_path, width="stretch")
 
@@ -808,17 +1317,10 @@ if os.path.exists(logo_path):
 st.sidebar.header("Configuration")
 
 # Dynamic scan for YAML configuration files
+# Adding or removing a file changes the directory mtime, which invalidates the cached scan
 product_groups = []
-prefix = "EUDAMED_data_"
-suffix = ".yaml"
-
 try:
-    for f in os.listdir(base_dir):
-        if f.startswith(prefix) and f.endswith(suffix):
-            # Extract group name
-            group_name = f[len(prefix):-len(suffix)]
-            product_groups.append(group_name)
-    product_groups.sort()
+    product_groups = discover_groups(_BASE_DIR, os.path.getmtime(_BASE_DIR))
 except Exception as e:
     st.sidebar.error(f"Error scanning for config files: {e}")
 
@@ -839,10 +1341,9 @@ if selected_group != "None":
         
         # Display current YAML in main area
         filename = f"EUDAMED_data_{selected_group}.yaml"
-        file_path = os.path.join(base_dir, filename)
+        file_path = os.path.join(_BASE_DIR, filename)
         if os.path.exists(file_path):
-             with open(file_path, 'r', encoding='utf-8') as f:
-                 yaml_content = f.read()
+             yaml_content = _read_config_text(file_path, os.path.getmtime(file_path))
              with st.expander("Current Default Values", expanded=False):
                  # Use 'properties' or 'text' to avoid red highlighting which can look like errors
                  st.code(yaml_content, language="properties")
@@ -866,8 +1367,31 @@ namespaces = {
     'marketinfo': 'https://ec.europa.eu/tools/eudamed/dtx/datamodel/Entity/MktInfo/MarketInfo/v1',
     'e': 'https://ec.europa.eu/tools/eudamed/dtx/datamodel/Entity/v1'
 }
-for prefix, uri in namespaces.items():
-    ET.register_namespace(prefix, uri)
+
+
+@st.cache_resource
+def _init_namespaces():
+    """Register the EUDAMED prefixes once per process and return '{uri}' tag prefixes."""
+    for prefix, uri in namespaces.items():
+        ET.register_namespace(prefix, uri)
+    return {prefix: '{' + uri + '}' for prefix, uri in namespaces.items()}
+
+
+NS = _init_namespaces()
+# Prefixes declared on the serialized root (see serialize_envelope)
+_OUTPUT_NSMAP = {('ns2' if prefix == 's' else prefix): uri for prefix, uri in namespaces.items()}
+
+# Qualified envelope tags (Message and Service namespaces), formatted once
+M = {t: NS['m'] + t for t in ('Push', 'correlationID', 'creationDateTime', 'messageID',
+                              'recipient', 'sender', 'node', 'service', 'payload')}
+S = {t: NS['s'] + t for t in ('nodeActorCode', 'serviceID', 'serviceOperation')}
+# find() paths of the envelope texts filled in for each generated file, per party
+_PARTY_PATHS = {
+    party: (f"{M[party]}/{M['node']}/{S['nodeActorCode']}",
+            f"{M[party]}/{M['service']}/{S['serviceID']}",
+            f"{M[party]}/{M['service']}/{S['serviceOperation']}")
+    for party in ('recipient', 'sender')
+}
 
 # Device Configuration Type Selection
 device_type_options = {
@@ -882,36 +1406,48 @@ st.sidebar.markdown("---")
 selected_device_type_label = st.sidebar.selectbox("Select Device Type", list(device_type_options.keys()))
 selected_root_element_name = device_type_options[selected_device_type_label]
 
-# Find root definition
-mdr_device_element = schema.elements.get(selected_root_element_name)
-if not mdr_device_element:
-    mdr_device_element = schema.elements.get(f"{{{namespaces['device']}}}{selected_root_element_name}")
+# Indentation is cosmetic; compact output is smaller and quicker to produce for large batches
+pretty_output = st.sidebar.checkbox("Pretty-print XML output", value=True,
+                                    help="Indent the generated XML. EUDAMED accepts compact XML as well.")
 
-# Look in imported maps if not found in root elements
-if not mdr_device_element and hasattr(schema, 'maps') and schema.maps and schema.maps.elements:
-    mdr_device_element = schema.maps.elements.get(f"{{{namespaces['device']}}}{selected_root_element_name}")
+@st.cache_resource(show_spinner=False)
+def resolve_device_defs(root_element_name, _schema):
+    """
+    Finds the device root element and its Basic UDI / UDI-DI Data particles.
+    These are pure lookups on the schema, so they are resolved once per device type.
+    Returns (root_element, basic_udi_def, udidi_data_def); missing parts are None.
+    """
+    # Find root definition. The device elements live in an imported namespace, so
+    # the Message schema's own element table never has them; the global map indexes
+    # every loaded namespace by qualified name and answers in a single lookup.
+    root_element = _schema.maps.elements.get(NS['device'] + root_element_name)
 
+    if not root_element:
+        return None, None, None
 
-if not mdr_device_element:
-    st.error(f"Could not find {selected_root_element_name} element definition in schema.")
-    st.stop()
+    basic_def = None
+    udidi_def = None
 
-mdr_device_type = mdr_device_element.type
-basic_udi_def = None
-udidi_data_def = None
+    # Logic to find the Basic UDI and UDI-DI Data parts based on naming conventions
+    # MDR: MDRBasicUDI, MDRUDIDIData
+    # Legacy: MDEUDI, MDEUData
+    # IVDR: IVDRBasicUDI, IVDRUDIDIData
+    # Legacy IVD: IVDEUDI, IVDEUData
 
-# Logic to find the Basic UDI and UDI-DI Data parts based on naming conventions
-# MDR: MDRBasicUDI, MDRUDIDIData
-# Legacy: MDEUDI, MDEUData
-# IVDR: IVDRBasicUDI, IVDRUDIDIData
-# Legacy IVD: IVDEUDI, IVDEUData
+    for particle in root_element.type.content.iter_model():
+        name = particle.name
+        if 'BasicUDI' in name or 'EUDI' in name:
+            basic_def = particle
+        elif 'UDIDIData' in name or 'EUData' in name:
+            udidi_def = particle
 
-for particle in mdr_device_type.content.iter_model():
-    name = particle.name
-    if 'BasicUDI' in name or 'EUDI' in name:
-        basic_udi_def = particle
-    elif 'UDIDIData' in name or 'EUData' in name:
-        udidi_data_def = particle
+    return root_element, basic_def, udidi_def
+
+mdr_device_element, basic_udi_def, udidi_data_def = resolve_device_defs(selected_root_element_name, schema)
+
+if not mdr_device_element:
+    st.error(f"Could not find {selected_root_element_name} element definition in schema.")
+    st.stop()
 
 if not basic_udi_def or not udidi_data_def:
     st.error(f"Structure mismatch for {selected_root_element_name}: Could not find Basic UDI or Data definitions.")
@@ -975,68 +1511,6 @@ else: # PATCH
 
 st.markdown("---")
 
-# Container for collecting data for CSV export
-data_collection_container = {'csv_entries': []}
-
-# We use a distinct key prefix
-basic_udi_path = f"Push/payload/{mdr_device_element.local_name}"
-# Add selected_group to key prefix to ensure widgets refresh when configuration changes
-basic_udi_key_prefix = f"root_{selected_group}_{selected_root_element_name}"
-
-if 'BasicUDI' in target_scope:
-    with st.expander("Basic UDI Configuration", expanded=True):
-        st.info("Fill in the mandatory fields for the Basic UDI. Min Occurs >= 1 fields only.")
-        basic_udi_data = render_input_fields(
-            basic_udi_def, 
-            basic_udi_def.type, 
-            basic_udi_key_prefix, 
-            data_collection_container, 
-            basic_udi_path, 
-            config_defaults,
-            metadata_csv
-        )
-else:
-    basic_udi_data = None
-
-if 'UDIDI' in target_scope:
-    with st.expander("UDI-DI Data Entries", expanded=True):
-        st.info("Fill in the mandatory fields for the UDI-DI. You can add multiple entries.")
-
-        # Determine limit based on service type
-        max_udis = 50
-        help_msg = "You can add multiple entries."
-        if service_id_override == "DEVICE":
-             max_udis = 1
-             help_msg = "Restricted to 1 entry for Full Device Registration (Device Service)."
-
-        # Always allow multiple UDI-DIs for generation, regardless of schema maxOccurs in the container.
-        # This supports "Add UDI-DI" scenarios (multiple messages) and bulk generation.
-        col_count, col_dummy = st.columns([2, 8])
-        with col_count:
-            num_udis = st.number_input("Number of UDI-DI entries", min_value=1, max_value=max_udis, value=1, help=help_msg)
-
-        udidi_data_list = []
-        udidi_base_path = f"Push/payload/{mdr_device_element.local_name}"
-        for i in range(num_udis):
-            with st.expander(f"UDI-DI Entry #{i+1}", expanded=False):
-                # Pass unique parent key with group prefix
-                group_key_prefix = f"root_{selected_group}_{selected_root_element_name}.udidi_{i}"
-                udidi_data = render_input_fields(
-                    udidi_data_def, 
-                    udidi_data_def.type, 
-                    group_key_prefix, 
-                    data_collection_container, 
-                    udidi_base_path,
-                    config_defaults,
-                    metadata_csv
-                )
-                udidi_data_list.append(udidi_data)
-else:
-    udidi_data_list = []
-
-
-st.markdown("---")
-
 # --- Data Source Controls ---
 data_source = st.radio("UDI-DI Source", ["Manual Form Entry", "IFS Database", "Sequence Generator"], horizontal=True)
 
@@ -1062,14 +1536,96 @@ elif data_source == "Sequence Generator":
         gen_count = st.number_input("Count", min_value=1, value=10, help="Number of UDI-DIs to generate.")
 
 st.markdown("---")
-# Action Buttons in columns
-col_gen, col_export = st.columns([1, 1])
 
-with col_gen:
-    submitted = st.button("Generate XML", type="primary")
+# Container for collecting data for CSV export
+data_collection_container = {'csv_entries': []}
+
+# We use a distinct key prefix
+basic_udi_path = f"Push/payload/{mdr_device_element.local_name}"
+# Add selected_group to key prefix to ensure widgets refresh when configuration changes
+basic_udi_key_prefix = f"root_{selected_group}_{selected_root_element_name}"
+
+if 'UDIDI' in target_scope:
+    # Determine limit based on service type
+    max_udis = 50
+    help_msg = "You can add multiple entries."
+    if service_id_override == "DEVICE":
+         max_udis = 1
+         help_msg = "Restricted to 1 entry for Full Device Registration (Device Service)."
+
+    # Always allow multiple UDI-DIs for generation, regardless of schema maxOccurs in the container.
+    # This supports "Add UDI-DI" scenarios (multiple messages) and bulk generation.
+    # Kept outside the form so that adding entries re-renders the form immediately.
+    col_count, col_dummy = st.columns([2, 8])
+    with col_count:
+        num_udis = st.number_input("Number of UDI-DI entries", min_value=1, max_value=max_udis, value=1, help=help_msg)
+
+# Field widgets live in a form: typing does not rerun the script, only the submit buttons do.
+with st.form("eudamed", border=False):
+    if 'BasicUDI' in target_scope:
+        with st.expander("Basic UDI Configuration", expanded=True):
+            st.info("Fill in the mandatory fields for the Basic UDI. Min Occurs >= 1 fields only.")
+            basic_udi_data = {}
+            # Each rendered record gets its own record key -> (tooltip path, widget key) map
+            basic_udi_widgets = data_collection_container['field_widgets'] = {}
+            render_plan(
+                build_render_plan(basic_udi_def.name, basic_udi_def, metadata_csv),
+                basic_udi_key_prefix, 
+                data_collection_container, 
+                basic_udi_data,
+                basic_udi_path, 
+                config_defaults
+            )
+    else:
+        basic_udi_data = None
+        basic_udi_widgets = {}
+
+    if 'UDIDI' in target_scope:
+        with st.expander("UDI-DI Data Entries", expanded=True):
+            st.info("Fill in the mandatory fields for the UDI-DI. You can add multiple entries.")
+
+            udidi_data_list = []
+            udidi_widgets_list = []
+            udidi_base_path = f"Push/payload/{mdr_device_element.local_name}"
+            # Every entry shares one compiled plan; only the widget key prefix differs.
+            # The plan stays a tree rather than a flat list because choices and list
+            # lengths are picked with widgets while it is being rendered.
+            udidi_plan = build_render_plan(udidi_data_def.name, udidi_data_def, metadata_csv)
+            # Unique parent key per entry, with the group prefix
+            udidi_key_prefix = f"{basic_udi_key_prefix}.udidi_"
+            for i in range(num_udis):
+                with st.expander(f"UDI-DI Entry #{i+1}", expanded=False):
+                    udidi_data = {}
+                    udidi_widgets_list.append({})
+                    data_collection_container['field_widgets'] = udidi_widgets_list[-1]
+                    render_plan(
+                        udidi_plan,
+                        f"{udidi_key_prefix}{i}", 
+                        data_collection_container, 
+                        udidi_data,
+                        udidi_base_path,
+                        config_defaults
+                    )
+                    udidi_data_list.append(udidi_data)
+    else:
+        udidi_data_list = []
+        udidi_widgets_list = []
+
+    st.markdown("---")
+    col_submit, col_apply = st.columns([1, 1])
+    with col_submit:
+        submitted = st.form_submit_button("Generate XML", type="primary")
+    with col_apply:
+        # List sizes and choices inside the form only take effect on submit
+        st.form_submit_button("Apply changes", help="Refresh list entries and choices without generating XML.")
+
+def build_excel_export(csv_entries, metadata_headers):
+    """Builds the Excel export of the collected field entries and returns the .xlsx bytes."""
+    from openpyxl import Workbook
+    from openpyxl.worksheet.table import Table, TableStyleInfo
+    from openpyxl.styles import Alignment
+    from openpyxl.utils import get_column_letter
 
-with col_export:
-    # Prepare Excel Data
     excel_buffer = io.BytesIO()
     wb = Workbook()
     ws = wb.active
@@ -1114,13 +1670,14 @@ with col_export:
     headers = [c[0] for c in final_columns_def]
     ws.append(headers)
 
-    # Write data
-    if 'csv_entries' in data_collection_container:
-        for entry in data_collection_container['csv_entries']:
-            row = []
-            for col_def in final_columns_def:
-                row.append(entry.get(col_def[1], ""))
-            ws.append(row)
+    # Write data; the schema columns take precedence, as when they were merged over the entry
+    data_keys = [col_def[1] for col_def in final_columns_def]
+    for xml_path, value, columns in csv_entries:
+        ws.append([columns[key] if key in columns
+                   else xml_path if key == 'XMLPath'
+                   else value if key == 'value'
+                   else ""
+                   for key in data_keys])
 
     # Create Table
     last_col_letter = get_column_letter(len(headers))
@@ -1159,11 +1716,17 @@ with col_export:
             ws.column_dimensions[col_letter].width = len(str(header)) + 5
 
     wb.save(excel_buffer)
-    excel_data = excel_buffer.getvalue()
+    return excel_buffer.getvalue()
+
+# Action Buttons in columns
+_, col_export = st.columns([1, 1])
 
+with col_export:
+    # The workbook is only built when the button is clicked: Streamlit calls the
+    # data callable on download instead of every rerun paying for openpyxl.
     st.download_button(
         label="Export Data to Excel",
-        data=excel_data,
+        data=functools.partial(build_excel_export, data_collection_container['csv_entries'], metadata_headers),
         file_name="eudamed_data_export.xlsx",
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     )
@@ -1194,6 +1757,56 @@ def calculate_mod10_checksum(number_str):
     check_digit = nearest_10 - total
     return str(check_digit)
 
+def build_zip(created_files):
+    """Packs the generated files into an in-memory ZIP archive and returns its bytes."""
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for cfile in created_files:
+            zip_file.writestr(cfile['name'], cfile['data'])
+    return zip_buffer.getvalue()
+
+# Larger files are only previewed in part; the download buttons carry the full bytes
+_PREVIEW_BYTES = 200_000
+
+@st.fragment
+def show_generated_files(created_files, zip_data):
+    """Lists the generated files with their validation result and download buttons."""
+    st.subheader("Generated XML Files")
+
+    # --- Bulk Download ---
+    if len(created_files) > 0:
+         st.download_button(
+             label="Download All XMLs (ZIP)",
+             data=zip_data,
+             file_name=f"EUDAMED_Bulk_{uuid.uuid4().hex[:8]}.zip",
+             mime="application/zip",
+             type="secondary"
+         )
+
+    for cfile in created_files:
+        with st.expander(f"{cfile['name']} ({cfile['validation_status']})", expanded=False):
+             if cfile['validation_status'] == "Valid":
+                 st.success(cfile['validation_details'])
+             elif cfile['validation_status'] == "Invalid":
+                 st.error(cfile['validation_details'])
+             else:
+                 st.warning(cfile['validation_details'])
+                 
+             data = cfile['data']
+             if len(data) > _PREVIEW_BYTES:
+                 # A cut inside a multi-byte character is dropped by errors="ignore"
+                 st.code(data[:_PREVIEW_BYTES].decode("utf-8", errors="ignore"), language="xml")
+                 st.caption(f"Preview shows the first {_PREVIEW_BYTES // 1000} kB of {len(data) // 1000} kB. Download the file for the full XML.")
+             else:
+                 st.code(data.decode("utf-8"), language="xml")
+             st.download_button(
+                label=f"Download {cfile['name']}",
+                data=cfile['data'],
+                file_name=cfile['name'],
+                mime="application/xml",
+                key=cfile['name']
+            )
+
 if submitted:
     st.success("Generating XML...")
     
@@ -1207,45 +1820,34 @@ if submitted:
         elif "BasicUDI" in clean_type:
              prefix = "device" 
         
-        elem.set(f"{{{namespaces['xsi']}}}type", f"{prefix}:{clean_type}")
+        elem.set(NS['xsi'] + "type", f"{prefix}:{clean_type}")
 
     # --- Data Processing (IFS/Generator) ---
     final_udidi_list = udidi_data_list # Default Manual
+    # Form entry each UDI-DI record was filled in from, for error reporting
+    final_udidi_entries = list(range(len(udidi_data_list)))
     
     # helper to safely update DICode and ReferenceNumber
     def update_udi_values(item_dict, udi_val):
         if not isinstance(item_dict, dict): return
         
-        # 1. Update Reference Number (direct child, varying namespaces possible)
-        # Iterate keys to find 'referenceNumber' regardless of namespace prefix
+        # Record keys are tuples of (qualified name, index) segments, see render_plan
         ref_num_key = None
-        for k in item_dict.keys():
-            if 'referenceNumber' in k: # e.g. 'udidi:referenceNumber' or just 'referenceNumber'
-                ref_num_key = k
-                break
+        di_code_key = None
+        for path in item_dict.keys():
+            names = [name for name, _ in path]
+            # 1. Reference Number (direct child, varying namespaces possible)
+            if ref_num_key is None and len(names) == 1 and 'referenceNumber' in names[0]:
+                ref_num_key = path
+            # 2. DICode in identifier (distinct from basicUDIIdentifier)
+            elif di_code_key is None and len(names) == 2 and 'identifier' in names[0] \
+                    and 'basicUDIIdentifier' not in names[0] and 'DICode' in names[1]:
+                di_code_key = path
         
         if ref_num_key:
-                item_dict[ref_num_key] = str(udi_val)
-        
-        # 2. Update DICode in identifier
-        # First find identifier key
-        ident_key = None
-        for k in item_dict.keys():
-            if 'identifier' in k and not 'basicUDIIdentifier' in k: # Distinct from basicUDIIdentifier
-                ident_key = k
-                break
-        
-        if ident_key and isinstance(item_dict[ident_key], dict):
-            ident_dict = item_dict[ident_key]
-            # Now look for DICode inside
-            di_code_key = None
-            for k in ident_dict.keys():
-                if 'DICode' in k:
-                    di_code_key = k
-                    break
-            
-            if di_code_key:
-                ident_dict[di_code_key] = str(udi_val)
+            item_dict[ref_num_key] = str(udi_val)
+        if di_code_key:
+            item_dict[di_code_key] = str(udi_val)
     
     generated_udi_strings = [] # Flat list of UDI codes from source
     
@@ -1270,6 +1872,7 @@ if submitted:
              
         # Process Data: Sort by DPT ASC, CYL ASC
         try:
+             import pandas as pd
              # Ensure numeric conversion for correct sorting
              df['dpt_num'] = pd.to_numeric(df['dpt'], errors='coerce').fillna(999999)
              df['cyl_num'] = pd.to_numeric(df['cyl'], errors='coerce').fillna(999999)
@@ -1313,17 +1916,18 @@ if submitted:
         # Apply to templates
         # 1. DEVICE / POST
         if service_op_mode.startswith("POST") and (service_id_override == "DEVICE" or post_type.startswith("Full")):
-            template = copy.deepcopy(udidi_data_list[0]) if udidi_data_list else {}
+            template = dict(udidi_data_list[0]) if udidi_data_list else {}
             
             update_udi_values(template, min_udi_value)
 
             final_udidi_list = [template] 
+            final_udidi_entries = [0]
         
         # 2. UDI_DI / POST or PATCH (Bulk Logic)
         elif (service_op_mode.startswith("POST") and service_id_override == "UDI_DI") or \
             (service_op_mode.startswith("PATCH") and 'UDIDI' in target_scope):
             
-            template = copy.deepcopy(udidi_data_list[0]) if udidi_data_list else {}
+            template = dict(udidi_data_list[0]) if udidi_data_list else {}
             new_list = []
             
             # Note: For PATCH operations we typically just want to generate updates for these UDIs.
@@ -1348,11 +1952,13 @@ if submitted:
                       source_list_for_bulk = generated_udi_strings
             
             for udi_val in source_list_for_bulk:
-                new_item = copy.deepcopy(template)
+                new_item = dict(template)
                 update_udi_values(new_item, udi_val)
                 new_list.append(new_item)
             
             final_udidi_list = new_list
+            # Every generated record is a copy of the first entry
+            final_udidi_entries = [0] * len(new_list)
 
     generation_tasks = []
 
@@ -1371,29 +1977,33 @@ if submitted:
             generation_tasks.append({'mode': 'PATCH', 'target': 'UDIDI', 'service_id': 'UDI_DI'})
 
     created_files = []
+    # Record key of the version leaf that PATCH payloads start with
+    version_key = ((NS['e'] + "version", None),)
 
     for idx, task in enumerate(generation_tasks):
         payload_blocks = [] # List of blocks to generate separate files
         
         if task['service_id'] == 'DEVICE': # Full Device
              # Single block with Minimum UDI-DI (if IFS) or whatever is in list
-             payload_blocks.append({'type': 'DEVICE', 'budi': basic_udi_data, 'udidis': final_udidi_list, 'index': 1, 'total': 1})
+             payload_blocks.append({'type': 'DEVICE', 'budi': basic_udi_data, 'udidis': final_udidi_list, 'entries': final_udidi_entries, 'index': 1, 'total': 1})
              
         elif task['service_id'] == 'UDI_DI': # UDI-DI POST or PATCH
              # Bulk Chunking
              chunk_size = 300
              all_items = final_udidi_list if final_udidi_list else []
+             all_entries = final_udidi_entries if final_udidi_list else []
              
              # Create chunks
              if not all_items:
                  # Handle case with no items (empty file? or skip?)
-                 payload_blocks.append({'type': 'UDIDI_BULK', 'items': [], 'index': 1, 'total': 1})
+                 payload_blocks.append({'type': 'UDIDI_BULK', 'items': [], 'entries': [], 'index': 1, 'total': 1})
              else:
                  chunk_indices = list(range(0, len(all_items), chunk_size))
                  total_chunks = len(chunk_indices)
                  for idx, i in enumerate(chunk_indices):
                       chunk = all_items[i:i + chunk_size]
-                      payload_blocks.append({'type': 'UDIDI_BULK', 'items': chunk, 'index': idx + 1, 'total': total_chunks})
+                      payload_blocks.append({'type': 'UDIDI_BULK', 'items': chunk, 'entries': all_entries[i:i + chunk_size],
+                                             'index': idx + 1, 'total': total_chunks})
                   
         elif task['target'] == 'BasicUDI':
              payload_blocks.append({'type': 'BasicUDI', 'data': basic_udi_data, 'index': 1, 'total': 1})
@@ -1403,64 +2013,72 @@ if submitted:
         
             # Root Payload for this file
             payload_elements = [] 
+            # (element position, record, widget map, label) of each streamed record, see locate_error
+            record_sources = []
 
             if block['type'] == 'DEVICE':
-                p_root = ET.Element(f"{{{namespaces['device']}}}Device")
-                type_name = clean_xsi_type_name(mdr_device_element.type.name)
-                set_xsi_type(p_root, type_name)
+                # The Device and all its records are streamed into one builder
+                device_tag = NS['device'] + "Device"
+                device_position = _PAYLOAD_POSITION + (("Device", 1),)
+                tb = ET.TreeBuilder()
+                tb.start(device_tag, {})
                 
                 # Add Basic UDI
                 if block['budi']:
                     budi_name = clean_xsi_type_name(basic_udi_def.name)
-                    basic_udi_elem = build_xml_element_manual_tag(f"{{{namespaces['device']}}}{budi_name}", block['budi'])
-                    p_root.append(basic_udi_elem)
+                    stream_record(tb, NS['device'] + budi_name, block['budi'])
+                    record_sources.append((device_position + ((budi_name, 1),), block['budi'],
+                                           basic_udi_widgets, "Basic UDI"))
                     
                 # Add UDI-DIs
-                for udi_data in block['udidis']:
+                udidi_count = 0
+                for udi_data, entry in zip(block['udidis'], block['entries']):
                     if udi_data:
                          udidi_name = clean_xsi_type_name(udidi_data_def.name)
-                         udidi_elem = build_xml_element_manual_tag(f"{{{namespaces['device']}}}{udidi_name}", udi_data)
-                         p_root.append(udidi_elem)
+                         stream_record(tb, NS['device'] + udidi_name, udi_data)
+                         udidi_count += 1
+                         record_sources.append((device_position + ((udidi_name, udidi_count),), udi_data,
+                                                udidi_widgets_list[entry], f"UDI-DI Entry #{entry + 1}"))
                 
+                tb.end(device_tag)
+                p_root = tb.close()
+                type_name = clean_xsi_type_name(mdr_device_element.type.name)
+                set_xsi_type(p_root, type_name)
                 payload_elements.append(p_root)
 
             elif block['type'] == 'UDIDI_BULK':
                 # Generate multiple UDIDIData elements
                 type_name = udidi_data_def.type.name if hasattr(udidi_data_def.type, 'name') else "MDRUDIDIDataType"
-                
-                for item in block['items']:
-                     p_root = ET.Element(f"{{{namespaces['device']}}}UDIDIData")
-                     set_xsi_type(p_root, f"udidi:{type_name}")
-                     
+
+                if task['mode'] == 'PATCH':
+                    # Add Version for PATCH
+                    # Check availability of patch_version
+                    ver_val = str(patch_version) if 'patch_version' in locals() else "1"
+
+                for position, (item, entry) in enumerate(zip(block['items'], block['entries']), 1):
                      if task['mode'] == 'PATCH':
-                         # Add Version for PATCH
-                         # Check availability of patch_version
-                         ver_val = str(patch_version) if 'patch_version' in locals() else "1"
-                         ver_elem = ET.Element(f"{{{namespaces['e']}}}version")
-                         ver_elem.text = ver_val
-                         p_root.insert(0, ver_elem)
-
-                     temp_elem = build_xml_element_manual_tag("TEMP", item)
-                     for child in temp_elem:
-                          p_root.append(child)
-                     
+                         # The version leaf goes first, so it is streamed as the first record entry
+                         item = {version_key: ver_val, **item}
+                     # Stream the record straight into the UDIDIData element
+                     p_root = build_xml_element_manual_tag(NS['device'] + "UDIDIData", item)
+                     set_xsi_type(p_root, f"udidi:{type_name}")
+                     record_sources.append((_PAYLOAD_POSITION + (("UDIDIData", position),), item,
+                                            udidi_widgets_list[entry], f"UDI-DI Entry #{entry + 1}"))
+
                      payload_elements.append(p_root)
 
             elif block['type'] == 'BasicUDI':
-                 p_root = ET.Element(f"{{{namespaces['device']}}}BasicUDI")
-                 type_name = basic_udi_def.type.name if hasattr(basic_udi_def.type, 'name') else "MDRBasicUDIType"
-                 set_xsi_type(p_root, f"device:{type_name}")
-                 
+                 basic_data = block['data']
                  if task['mode'] == 'PATCH':
                      ver_val = str(patch_version) if 'patch_version' in locals() else "1"
-                     ver_elem = ET.Element(f"{{{namespaces['e']}}}version")
-                     ver_elem.text = ver_val
-                     p_root.insert(0, ver_elem)
-                 
-                 temp_elem = build_xml_element_manual_tag("TEMP", block['data'])
-                 for child in temp_elem:
-                      p_root.append(child)
-                 
+                     basic_data = {version_key: ver_val, **basic_data}
+                 # Stream the record straight into the BasicUDI element
+                 p_root = build_xml_element_manual_tag(NS['device'] + "BasicUDI", basic_data)
+                 record_sources.append((_PAYLOAD_POSITION + (("BasicUDI", 1),), basic_data,
+                                        basic_udi_widgets, "Basic UDI"))
+                 type_name = basic_udi_def.type.name if hasattr(basic_udi_def.type, 'name') else "MDRBasicUDIType"
+                 set_xsi_type(p_root, f"device:{type_name}")
+
                  payload_elements.append(p_root)
 
             if not payload_elements: continue
@@ -1474,74 +2092,45 @@ if submitted:
                 sec_token = config_defaults.get('Push/header/security_token', '')
                 party_id = config_defaults.get('Push/header/party_id', '')
 
-            m_ns = f"{{{namespaces['m']}}}"
-            ns2_ns = f"{{{namespaces['s']}}}"
-            
-            root = ET.Element(f"{m_ns}Push")
-            
-            root.set(f"{{{namespaces['xsi']}}}schemaLocation", 
-                     f"{namespaces['m']} https://webgate.ec.europa.eu/tools/eudamed/dtx/service/Message.xsd")
-            root.set("version", "3.0.25")
-            
-            corr_id = ET.SubElement(root, f"{m_ns}correlationID")
-            corr_id.text = str(uuid.uuid4())
-            
-            create_dt = ET.SubElement(root, f"{m_ns}creationDateTime")
-            create_dt.text = datetime.datetime.now(datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
-            
-            msg_id = ET.SubElement(root, f"{m_ns}messageID")
-            msg_id.text = str(uuid.uuid4())
-            
-            recipient = ET.SubElement(root, f"{m_ns}recipient")
-            node = ET.SubElement(recipient, f"{m_ns}node")
-            node_actor = ET.SubElement(node, f"{ns2_ns}nodeActorCode")
-            node_actor.text = "EUDAMED"
-            
-            service = ET.SubElement(recipient, f"{m_ns}service")
-            svc_id = ET.SubElement(service, f"{ns2_ns}serviceID")
-            svc_id.text = task['service_id']
-            svc_op = ET.SubElement(service, f"{ns2_ns}serviceOperation")
-            svc_op.text = task['mode']
-            
+            # The envelope layout is fixed: clone the cached skeleton and fill in the texts
+            root = copy.deepcopy(build_envelope_skeleton())
+
+            root.find(M['correlationID']).text = str(uuid.uuid4())
+            root.find(M['creationDateTime']).text = datetime.datetime.now(datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
+            root.find(M['messageID']).text = str(uuid.uuid4())
+
+            actor_path, service_id_path, operation_path = _PARTY_PATHS['recipient']
+            root.find(actor_path).text = "EUDAMED"
+            root.find(service_id_path).text = task['service_id']
+            root.find(operation_path).text = task['mode']
+
             # <m:payload>
-            payload = ET.SubElement(root, f"{m_ns}payload")
+            payload = root.find(M['payload'])
             # Append all elements for this block
-            for pe in payload_elements:
-                payload.append(pe)
-            
-            sender = ET.SubElement(root, f"{m_ns}sender")
-            s_node = ET.SubElement(sender, f"{m_ns}node")
-            s_node_actor = ET.SubElement(s_node, f"{ns2_ns}nodeActorCode")
-            s_node_actor.text = actor_code
-            
-            s_service = ET.SubElement(sender, f"{m_ns}service")
-            s_site_id = ET.SubElement(s_service, f"{ns2_ns}serviceID")
-            s_site_id.text = task['service_id']
-            s_svc_op = ET.SubElement(s_service, f"{ns2_ns}serviceOperation")
-            s_svc_op.text = task['mode']
-
-            rough_string = ET.tostring(root, encoding="utf-8")
-            reparsed = xml.dom.minidom.parseString(rough_string)
-            final_xml = reparsed.toprettyxml(indent="  ", encoding="utf-8").decode("utf-8")
-            
-            final_xml = final_xml.replace('xmlns:s=', 'xmlns:ns2=')
-            final_xml = final_xml.replace('<s:', '<ns2:')
-            final_xml = final_xml.replace('</s:', '</ns2:')
+            payload.extend(payload_elements)
+
+            actor_path, service_id_path, operation_path = _PARTY_PATHS['sender']
+            root.find(actor_path).text = actor_code
+            root.find(service_id_path).text = task['service_id']
+            root.find(operation_path).text = task['mode']
 
-            final_xml = re.sub(r'\n\s*\n', '\n', final_xml)
+            xml_bytes = serialize_envelope(root, pretty=pretty_output)
 
             validation_status = "Unknown"
             validation_details = ""
             try:
-                if schema.is_valid(final_xml):
+                # Validate the tree already in memory instead of re-parsing the serialized XML.
+                # This is the only full validation: all field errors are collected in one pass.
+                errors = validate_envelope(root)
+                if not errors:
                     validation_status = "Valid"
                     validation_details = "✅ XML is valid against the schema."
                 else:
                     validation_status = "Invalid"
-                    try:
-                        schema.validate(final_xml)
-                    except Exception as e:
-                        validation_details = f"❌ Validation Error: {e}"
+                    # Report each error at the field path shown in the input widget tooltips
+                    source_index = index_record_sources(record_sources)
+                    error_lines = "\n".join(format_error(path, reason, source_index) for path, reason in errors)
+                    validation_details = f"❌ {len(errors)} Validation Error(s):\n\n{error_lines}"
             except Exception as e:
                  validation_status = "Error"
                  validation_details = f"⚠️ Validation Process Failed: {e}"
@@ -1569,47 +2158,16 @@ if submitted:
             
             created_files.append({
                 'name': fname, 
-                'content': final_xml, 
+                # Only the serialized bytes are kept; the text is decoded when displayed
+                'data': xml_bytes,
                 'label': f"{task['service_id']} {task['mode']} ({block['type']})",
                 'validation_status': validation_status,
                 'validation_details': validation_details
             })
 
-    st.subheader("Generated XML Files")
-    
-    for cfile in created_files:
-        with st.expander(f"{cfile['name']} ({cfile['validation_status']})", expanded=False):
-             if cfile['validation_status'] == "Valid":
-                 st.success(cfile['validation_details'])
-             elif cfile['validation_status'] == "Invalid":
-                 st.error(cfile['validation_details'])
-             else:
-                 st.warning(cfile['validation_details'])
-                 
-             st.code(cfile['content'], language="xml")
-             st.download_button(
-                label=f"Download {cfile['name']}",
-                data=cfile['content'],
-                file_name=cfile['name'],
-                mime="application/xml",
-                key=cfile['name']
-            )
-
-    # --- Bulk Download ---
-    if len(created_files) > 0:
-        with col_gen:
-             # Create a Zip File in memory
-             zip_buffer = io.BytesIO()
-             with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-                 for cfile in created_files:
-                     zip_file.writestr(cfile['name'], cfile['content'])
-             
-             st.download_button(
-                 label="Download All XMLs (ZIP)",
-                 data=zip_buffer.getvalue(),
-                 file_name=f"EUDAMED_Bulk_{uuid.uuid4().hex[:8]}.zip",
-                 mime="application/zip",
-                 type="secondary"
-             )
+    # Results are rendered in a fragment: download clicks rerun only that section,
+    # so generation and validation are not repeated and the results stay visible.
+    # The fragment reuses its arguments on those reruns, so the ZIP is compressed once.
+    show_generated_files(created_files, build_zip(created_files) if created_files else None)
 
 
@@ -0,0 +1,62 @@
+"""Validation errors are reported at the tooltip path of the field they belong to."""
+import os
+import re
+import unittest
+
+from streamlit.testing.v1 import AppTest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "generate_xml_streamlit.py")
+
+
+def start_app(group):
+    at = AppTest.from_file(APP_PATH, default_timeout=120)
+    at.run()
+    at.sidebar.selectbox[0].set_value(group).run()
+    return at
+
+
+def tooltip_path(widget):
+    """Returns the path shown in the first line of a field tooltip."""
+    return re.match(r"📍 Path: `([^`]*)`", widget.help).group(1)
+
+
+def generate(at):
+    [b for b in at.button if b.label == "Generate XML"][0].click().run()
+    assert not at.exception, at.exception
+    return [e.value for e in at.error]
+
+
+class ValidationErrorPathTest(unittest.TestCase):
+
+    def test_basic_udi_error_at_tooltip_path(self):
+        at = start_app("ViscoHA")
+        model = [w for w in at.text_input if w.key.endswith(".MDRBasicUDI.model")][0]
+        self.assertEqual(model.value, "")
+
+        errors = "\n".join(generate(at))
+        self.assertIn(f"- `{tooltip_path(model)}` (Basic UDI): ", errors)
+        self.assertEqual(tooltip_path(model), "Push/payload/MDRDevice/MDRBasicUDI/model")
+
+    def test_list_entry_error_uses_tooltip_index(self):
+        at = start_app("None")
+        number = [w for w in at.text_input if w.key.endswith(".certificate.certificateNumber")][0]
+        # Tooltips number list entries from 0, XPath positions in the raw error from 1
+        self.assertIn("[0]", tooltip_path(number))
+
+        errors = "\n".join(generate(at))
+        self.assertIn(f"- `{tooltip_path(number)}` (Basic UDI): ", errors)
+
+    def test_udidi_error_names_its_entry(self):
+        at = start_app("Lens_677TAY")
+        at.radio[1].set_value("Add UDI-DI(s) only").run()
+        [n for n in at.number_input if n.label == "Number of UDI-DI entries"][0].set_value(2).run()
+        reuses = [w for w in at.text_input if w.key.endswith(".udidi_1.MDRUDIDIData.numberOfReuses")][0]
+        reuses.set_value("many")
+
+        errors = "\n".join(generate(at))
+        self.assertIn(f"- `{tooltip_path(reuses)}` (UDI-DI Entry #2): ", errors)
+        self.assertNotIn("(UDI-DI Entry #1)", errors)
+
+
+if __name__ == "__main__":
+    unittest.main()